@@ -17,6 +17,9 @@ import urllib.parse
 
 import requests
 
+import codec
+import telemetry
+
 
 log = logging.getLogger(__name__)
 
@@ -25,8 +28,14 @@ API_URL = 'https://cointracking.info/api/v1/'
 API_KEY = os.environ['COINTRACKING_API_KEY']
 API_SECRET = os.environ['COINTRACKING_API_SECRET'].encode('utf-8')
 
+# Minimum seconds between two requests, to stay below the API's request limit. 0 disables the throttle.
+API_MIN_INTERVAL = float(os.environ.get('COINTRACKING_API_MIN_INTERVAL', 0))
+
+_last_request = None
+
 
 def _api_call(api_method, **kwargs):
+    global _last_request
     payload = {}
 
     # Copy over any argument that's none None (None would use API default).
@@ -35,6 +44,14 @@ def _api_call(api_method, **kwargs):
             payload[key] = kwargs[key]
 
     payload['method'] = api_method
+
+    throttle_wait = 0.0
+    if API_MIN_INTERVAL and _last_request is not None:
+        throttle_wait = max(0.0, _last_request + API_MIN_INTERVAL - time.monotonic())
+        if throttle_wait:
+            log.debug("Throttling %s for %.2fs", api_method, throttle_wait)
+            time.sleep(throttle_wait)
+
     payload['nonce'] = int(time.time() * 1000)
 
     payload_bytes = urllib.parse.urlencode(payload).encode('utf8')
@@ -45,8 +62,11 @@ def _api_call(api_method, **kwargs):
         'Sign': signed_payload,
     }
 
+    start = time.perf_counter()
     r = requests.post(API_URL, headers=headers, data=payload)
-    return r.json()
+    _last_request = time.monotonic()
+    telemetry.request(api_method, time.perf_counter() - start, throttle_wait, r.status_code, len(r.content))
+    return codec.loads(r.content)
 
 
 def get_trades(limit=None, order=None, start_time=None, end_time=None):
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Generates tax reports for many CoinTracking accounts in one go.
+
+The manifest is a json list of accounts:
+
+    [
+        {"name": "alice", "input": "data/alice.json", "output": "out/alice.csv"},
+        {"name": "bob", "input": "data/bob.csv", "output": "out/bob.csv",
+         "open_lots": "out/bob_lots.json", "method": "HIFO", "spool": true, "prices": "data/prices.idx"}
+    ]
+
+Every account gets its own ledger and its own log file (`<output>.log`) with the engine's
+messages. Accounts are spread over a pool of worker processes, largest input first.
+The summary file lists status and timing per account.
+"""
+import contextlib
+import os
+import sys
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import codec
+from generate_tax_report import generate_report
+from price_index import PriceStore
+from tools import write_json
+
+
+def run_account(account):
+    """
+    Generates the report for one account. Runs in a worker process.
+    :param account: manifest entry
+    :type account: dict
+    :return: status entry for the summary
+    :rtype: OrderedDict
+    """
+    log_filename = account.get('log', account['output'] + '.log')
+    status = OrderedDict([
+        ('name', account['name']),
+        ('input', account['input']),
+        ('output', account['output']),
+        ('log', log_filename),
+        ('status', 'ok'),
+        ('error', None),
+        ('transactions', None),
+        ('open_positions', None),
+        ('diagnostics', None),
+        ('seconds', None),
+    ])
+
+    start = time.perf_counter()
+    with open(log_filename, 'w') as log_file, contextlib.redirect_stdout(log_file):
+        try:
+            price_store = PriceStore.open(account['prices']) if account.get('prices') else None
+            ledger = generate_report(account['input'], account['output'],
+                                     account.get('open_lots'), account.get('method', 'FIFO'),
+                                     account.get('spool', False), price_store=price_store)
+            status['transactions'] = ledger.transaction_count
+            status['open_positions'] = len(ledger.open_lots().positions())
+            status['diagnostics'] = ledger.diagnostics.summary()
+        # The engine calls exit(1) on data errors, which must not take the worker down.
+        except (Exception, SystemExit) as e:
+            traceback.print_exc(file=log_file)
+            status['status'] = 'error'
+            status['error'] = repr(e)
+    status['seconds'] = round(time.perf_counter() - start, 3)
+    return status
+
+
+def read_manifest(filename):
+    with open(filename) as f:
+        accounts = codec.load(f)
+    for i, account in enumerate(accounts):
+        for key in ('input', 'output'):
+            if key not in account:
+                raise ValueError(f"Manifest entry {i} is missing '{key}'")
+        account.setdefault('name', os.path.splitext(os.path.basename(account['input']))[0])
+    return accounts
+
+
+def main():
+    if len(sys.argv) not in (3, 4):
+        print(f"Usage: {sys.argv[0]} <manifest_json> <summary_json> [workers]")
+        exit(1)
+
+    accounts = read_manifest(sys.argv[1])
+    workers = int(sys.argv[3]) if len(sys.argv) == 4 else None
+
+    # Largest inputs first so a big account does not end up running alone at the end.
+    accounts.sort(key=lambda account: os.path.getsize(account['input']) if os.path.exists(account['input']) else 0,
+                  reverse=True)
+
+    start = time.perf_counter()
+    statuses = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_account, account): account for account in accounts}
+        for future in as_completed(futures):
+            status = future.result()
+            statuses.append(status)
+            print(f"{status['status']:>5}  {status['seconds']:>8.3f}s  {status['name']}")
+
+    statuses.sort(key=lambda status: status['name'])
+    summary = OrderedDict([
+        ('accounts', len(statuses)),
+        ('failed', sum(1 for status in statuses if status['status'] != 'ok')),
+        ('seconds', round(time.perf_counter() - start, 3)),
+        ('results', statuses),
+    ])
+    write_json(summary, sys.argv[2])
+
+    print(f"Processed {summary['accounts']} accounts, {summary['failed']} failed.")
+    if summary['failed']:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Checks a whole trade dataset for the problems that make generate_tax_report.py stop or produce
+wrong results, and reports all of them at once instead of one per run.
+
+Checks:
+ - `negative_balance`: the running balance of an (exchange, currency) goes below zero,
+   i.e. coins are sold, spent or withdrawn before they were bought or deposited
+ - `usd_leg_mismatch`: a trade with a USD leg whose usd value differs from the USD amount
+ - `missing_usd_value`: a trade, spend or income without a USD leg and without the usd value
+   the tax engine derives the basis from (the sell side's, or the buy side's if nothing is sold).
+   Trades with no usd value at all are skipped by the engine, the others stop it.
+ - `unknown_type`: a trade type the tax engine does not handle
+
+Cancelled and failed trades are ignored like in the tax engine. The dataset is loaded into
+columns once and every check is a vectorized numpy operation over all rows, so even millions
+of trades are checked in seconds. Problems are grouped (per exchange and currency, or per type)
+and ranked by the number of affected trades.
+
+Requires numpy.
+
+Usage:
+
+    python check_integrity.py data/combined.json [--output report.json] [--limit 20]
+"""
+import argparse
+import itertools
+from collections import OrderedDict
+from datetime import datetime
+
+try:
+    # noinspection PyUnresolvedReferences
+    import numpy as np
+    numpy_available = True
+except ImportError:
+    numpy_available = False
+
+from tools import parse_time, read_trades_from_file, write_json
+
+
+NEGATIVE_BALANCE = 'negative_balance'
+USD_LEG_MISMATCH = 'usd_leg_mismatch'
+MISSING_USD_VALUE = 'missing_usd_value'
+UNKNOWN_TYPE = 'unknown_type'
+
+# Trade types generate_tax_report.Ledger.process_trades handles.
+KNOWN_TYPES = ('Trade', 'Deposit', 'Withdrawal', 'Spend', 'Donation', 'Gift', 'Gift(Out)', 'Stolen', 'Income')
+MOVEMENT_TYPES = ('Deposit', 'Withdrawal')
+
+# Balances are summed up as floats; anything closer to zero than this is rounding.
+BALANCE_TOLERANCE = 1e-6
+
+# Allowed difference between the amount of a USD leg and its usd value, in USD.
+USD_TOLERANCE = 0.01
+
+MAX_EXAMPLES = 5
+
+STRING_FIELDS = ('type', 'trade_id', 'exchange', 'buy_currency', 'sell_currency', 'group', 'comment')
+AMOUNT_FIELDS = ('buy_amount', 'sell_amount', 'buy_value_usd', 'sell_value_usd')
+
+
+def amount_column(values):
+    """
+    Converts raw amounts (strings as exported, or numbers) to a float array. Empty values and `-` are 0.
+    """
+    return np.array([0.0 if value == '' or value == '-' else value for value in values], dtype=np.float64)
+
+
+def time_column(values):
+    """
+    Converts raw times to an array of unix timestamps.
+    Tries the fast paths (all timestamps, all ISO dates) before parsing every value on its own.
+    """
+    values = [value.strip() if isinstance(value, str) else value for value in values]
+    try:
+        return np.array(values, dtype=np.int64)
+    except ValueError:
+        pass
+    try:
+        return np.array(values, dtype='datetime64[s]').astype(np.int64)
+    except ValueError:
+        pass
+    epoch = datetime(1970, 1, 1)
+    return np.array([int((parse_time(value) - epoch).total_seconds()) for value in values], dtype=np.int64)
+
+
+def load_columns(filename, batch_size=1 << 16):
+    """
+    Reads a trade file into one numpy array per field.
+    :rtype: dict
+    """
+    fields = STRING_FIELDS + AMOUNT_FIELDS + ('time',)
+    raw = {field: [] for field in fields}
+    trades = iter(read_trades_from_file(filename, stream=True))
+    while True:
+        batch = list(itertools.islice(trades, batch_size))
+        if not batch:
+            break
+        for field in fields:
+            raw[field].extend([trade.get(field, '') for trade in batch])
+
+    columns = {field: np.char.strip(np.array(raw.pop(field), dtype=str)) for field in STRING_FIELDS}
+    for field in AMOUNT_FIELDS:
+        columns[field] = amount_column(raw.pop(field))
+    columns['time'] = time_column(raw.pop('time'))
+    return columns
+
+
+def cancelled_mask(columns):
+    """
+    Same rule as the tax engine: "cancelled" or "failed" in comment or group.
+    """
+    mask = np.zeros(len(columns['type']), dtype=bool)
+    for field in ('comment', 'group'):
+        lowered = np.char.lower(columns[field])
+        for word in ('cancelled', 'failed'):
+            mask |= np.char.find(lowered, word) >= 0
+    return mask
+
+
+def _finding(category, subject, rows, columns, magnitude=None, first_time=None):
+    """
+    Builds a report entry for a group of affected rows.
+    :param rows: indices of the affected rows, in time order
+    """
+    return OrderedDict([
+        ('category', category),
+        ('subject', subject),
+        ('count', int(len(rows))),
+        ('magnitude', None if magnitude is None else float(magnitude)),
+        ('first_time', datetime.utcfromtimestamp(int(columns['time'][rows[0]] if first_time is None
+                                                     else first_time)).isoformat()),
+        ('examples', [str(trade_id) for trade_id in columns['trade_id'][rows[:MAX_EXAMPLES]]]),
+    ])
+
+
+def _grouped(category, mask, keys, columns, magnitudes=None):
+    """
+    Groups the rows selected by `mask` by `keys` and returns one finding per group.
+    """
+    rows = np.flatnonzero(mask)
+    if len(rows) == 0:
+        return []
+    rows = rows[np.argsort(columns['time'][rows], kind='stable')]
+    group_keys, inverse = np.unique(keys[rows], return_inverse=True)
+    findings = []
+    for i, key in enumerate(group_keys):
+        group = rows[inverse == i]
+        magnitude = None if magnitudes is None else np.abs(magnitudes[group]).max()
+        findings.append(_finding(category, str(key), group, columns, magnitude))
+    return findings
+
+
+def check_unknown_types(columns, active):
+    mask = active & ~np.isin(columns['type'], KNOWN_TYPES)
+    return _grouped(UNKNOWN_TYPE, mask, columns['type'], columns)
+
+
+def check_usd_legs(columns, active):
+    findings = []
+    for leg in ('buy', 'sell'):
+        amount = columns[f'{leg}_amount']
+        value = columns[f'{leg}_value_usd']
+        difference = amount - value
+        # A usd value of 0 means "not set"; the tax engine takes the USD amount then.
+        mask = active & (columns[f'{leg}_currency'] == 'USD') & (value != 0) & (np.abs(difference) > USD_TOLERANCE)
+        findings.extend(_grouped(USD_LEG_MISMATCH, mask, np.char.add(columns['exchange'], f' {leg}'), columns,
+                                 difference))
+    return findings
+
+
+def check_missing_usd_values(columns, active):
+    mask = active & ~np.isin(columns['type'], MOVEMENT_TYPES) & np.isin(columns['type'], KNOWN_TYPES)
+    mask &= (columns['buy_currency'] != 'USD') & (columns['sell_currency'] != 'USD')
+    # See generate_tax_report.determine_basis.
+    mask &= np.where(columns['sell_currency'] == '', columns['buy_value_usd'] == 0, columns['sell_value_usd'] == 0)
+    currency = np.where(columns['sell_currency'] != '', columns['sell_currency'], columns['buy_currency'])
+    return _grouped(MISSING_USD_VALUE, mask, np.char.add(np.char.add(columns['exchange'], ' '), currency), columns)
+
+
+def check_balances(columns, active):
+    """
+    Replays all buy and sell legs per (exchange, currency) with one sort and one cumulative sum.
+    """
+    legs = []
+    for leg, sign in (('buy', 1.0), ('sell', -1.0)):
+        mask = active & (columns[f'{leg}_currency'] != '') & (columns[f'{leg}_currency'] != 'USD') \
+            & (columns[f'{leg}_amount'] != 0)
+        rows = np.flatnonzero(mask)
+        legs.append((rows, sign * columns[f'{leg}_amount'][rows],
+                     np.char.add(np.char.add(columns['exchange'][rows], ' '), columns[f'{leg}_currency'][rows])))
+    rows = np.concatenate([leg[0] for leg in legs])
+    deltas = np.concatenate([leg[1] for leg in legs])
+    keys = np.concatenate([leg[2] for leg in legs])
+    if len(rows) == 0:
+        return []
+
+    group_keys, codes = np.unique(keys, return_inverse=True)
+    times = columns['time'][rows]
+    # Per key in time order; at the same time, coins come in before they go out.
+    order = np.lexsort((deltas < 0, times, codes))
+    rows, deltas, codes, times = rows[order], deltas[order], codes[order], times[order]
+
+    running = np.cumsum(deltas)
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    offsets = np.r_[0.0, running[starts[1:] - 1]]
+    running -= np.repeat(offsets, np.diff(np.r_[starts, len(codes)]))
+
+    negative = running < -BALANCE_TOLERANCE
+    findings = []
+    for code in np.unique(codes[negative]):
+        selected = negative & (codes == code)
+        findings.append(_finding(NEGATIVE_BALANCE, str(group_keys[code]), rows[selected], columns,
+                                 -running[selected].min()))
+    return findings
+
+
+CHECKS = (check_balances, check_usd_legs, check_missing_usd_values, check_unknown_types)
+
+
+def check_integrity(columns):
+    """
+    Runs all checks.
+    :param columns: see `load_columns`
+    :type columns: dict
+    :return: findings, most affected trades first
+    :rtype: list<OrderedDict>
+    """
+    active = ~cancelled_mask(columns)
+    findings = []
+    # Overflowing amounts (inf) are reported through the checks, not as numpy warnings.
+    with np.errstate(invalid='ignore'):
+        for check in CHECKS:
+            findings.extend(check(columns, active))
+    findings.sort(key=lambda finding: (-finding['count'], -(finding['magnitude'] or 0)))
+    return findings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reports all data problems in a trade file at once.")
+    parser.add_argument('input', metavar='json_or_csv_file')
+    parser.add_argument('--output', metavar='report_json', help="also write the full report as json")
+    parser.add_argument('--limit', type=int, default=20, help="number of problems printed (default: 20)")
+    args = parser.parse_args()
+
+    if not numpy_available:
+        print("check_integrity.py requires numpy (pip install numpy).")
+        exit(1)
+
+    columns = load_columns(args.input)
+    findings = check_integrity(columns)
+
+    if args.output is not None:
+        write_json(findings, args.output)
+
+    print(f"{'category':<20}{'subject':<24}{'count':>8}{'magnitude':>18}  {'first_time':<21}examples")
+    for finding in findings[:args.limit]:
+        magnitude = '' if finding['magnitude'] is None else f"{finding['magnitude']:.8f}"
+        print(f"{finding['category']:<20}{finding['subject']:<24}{finding['count']:>8}{magnitude:>18}  "
+              f"{finding['first_time']:<21}{', '.join(finding['examples'])}")
+    if len(findings) > args.limit:
+        print(f"... {len(findings) - args.limit} more, see --output")
+
+    print(f"Checked {len(columns['type'])} trades, found {len(findings)} problems "
+          f"affecting {sum(finding['count'] for finding in findings)} trades.")
+    if findings:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+The json codec used by all modules.
+
+Uses simplejson (with its C speedups) if it is installed and the standard library otherwise.
+Both backends parse numbers with a fraction or exponent straight into `Decimal`, never via float,
+so amounts from api responses or hand-written files keep their exact value. Objects are parsed
+into plain dicts, which keep the key order of the document.
+
+`Decimal` values are written as strings in plain notation (`'{0:f}'`), the same format the
+trade and transaction exports use, so they read back exactly with either backend.
+"""
+import json
+from decimal import Decimal
+
+try:
+    # noinspection PyUnresolvedReferences
+    import simplejson
+    simplejson_available = True
+except ImportError:
+    simplejson_available = False
+
+
+backend = 'simplejson' if simplejson_available else 'json'
+
+COMPACT_SEPARATORS = (',', ':')
+
+
+def _default(value, fallback=None):
+    if isinstance(value, Decimal):
+        return '{0:f}'.format(value)
+    if fallback is not None:
+        return fallback(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not json serializable")
+
+
+def loads(s):
+    """
+    Parses a json document. Numbers with a fraction or exponent become `Decimal`, integers `int`.
+    :param s: json document
+    :type s: str|bytes
+    """
+    if simplejson_available:
+        return simplejson.loads(s, use_decimal=True)
+    return json.loads(s, parse_float=Decimal)
+
+
+def load(f):
+    """
+    Parses a json document from a file, see `loads`.
+    """
+    return loads(f.read())
+
+
+def _decoder():
+    if simplejson_available:
+        return simplejson.JSONDecoder(parse_float=Decimal)
+    return json.JSONDecoder(parse_float=Decimal)
+
+
+def iter_array(f, chunk_size=1 << 16):
+    """
+    Parses a json array from a file element by element, so only the current element and one chunk
+    of the file are held in memory.
+    :param f: File opened in text mode.
+    :param chunk_size: Number of characters read at a time.
+    :type chunk_size: int
+    :rtype: generator
+    """
+    decoder = _decoder()
+    buffer = f.read(chunk_size)
+    eof = not buffer
+    position = 0
+
+    def skip(characters):
+        nonlocal buffer, position, eof
+        while True:
+            while position < len(buffer) and buffer[position] in characters:
+                position += 1
+            if position < len(buffer) or eof:
+                return
+            buffer = f.read(chunk_size)
+            position = 0
+            eof = not buffer
+
+    skip(' \t\r\n')
+    if position >= len(buffer) or buffer[position] != '[':
+        raise ValueError("Expected a json array")
+    position += 1
+    while True:
+        skip(' \t\r\n,')
+        if position >= len(buffer):
+            raise ValueError("Unterminated json array")
+        if buffer[position] == ']':
+            return
+        try:
+            value, end = decoder.raw_decode(buffer, position)
+            # A number may continue in the next chunk ("2" of "2.50"): a value only counts as complete
+            # once the separator after it is in the buffer.
+            complete = eof or (end < len(buffer) and buffer[end] in ',] \t\r\n')
+        except ValueError:
+            if eof:
+                raise
+            complete = False
+        if not complete:
+            more = f.read(chunk_size)
+            eof = not more
+            buffer = buffer[position:] + more
+            position = 0
+            continue
+        position = end
+        yield value
+
+
+def dumps(data, indent=None, compact=False, default=None):
+    """
+    Serializes data to json.
+    :param indent: Number of spaces to indent, None for a single line.
+    :type indent: int
+    :param compact: Leave out the spaces after separators.
+    :type compact: bool
+    :param default: Optional function for values that are neither json types nor `Decimal`, e.g. `str`.
+    :type default: callable
+    :rtype: str
+    """
+    separators = COMPACT_SEPARATORS if compact else None
+    if simplejson_available:
+        return simplejson.dumps(data, indent=indent, separators=separators, use_decimal=False,
+                                default=lambda value: _default(value, default))
+    return json.dumps(data, indent=indent, separators=separators, default=lambda value: _default(value, default))
+
+
+def dump(data, f, indent=None, compact=False, default=None):
+    """
+    Serializes data to json and writes it to a file, see `dumps`.
+    """
+    f.write(dumps(data, indent, compact, default))
@@ -1,15 +1,17 @@
 # -*- coding: utf-8 -*-
-import json
 import sys
-from tools import read_trades_from_file, convert_trade_objs
+import telemetry
+from tools import read_trades_from_file, convert_trade_objs, write_json
 
 
-if len(sys.argv) != 4:
-    print("Usage: {} <dst_json_or_csv_file> <json_or_csv_file_with_seconds> <output_json>".format(sys.argv[0]))
+args = telemetry.setup_from_argv([arg for arg in sys.argv[1:] if arg != '--compact'])
+if len(args) != 3:
+    print("Usage: {} <dst_json_or_csv_file> <json_or_csv_file_with_seconds> <output_json> [--compact] "
+          "[--progress] [--metrics <metrics_json>]".format(sys.argv[0]))
     exit(1)
 
-trade_objs_1 = convert_trade_objs(read_trades_from_file(sys.argv[1]))
-trade_objs_2 = convert_trade_objs(read_trades_from_file(sys.argv[2]))
+trade_objs_1 = convert_trade_objs(read_trades_from_file(args[0]), lazy=True)
+trade_objs_2 = convert_trade_objs(read_trades_from_file(args[1]), lazy=True)
 
 for trade_with_seconds in trade_objs_2:
     time_with_seconds = trade_with_seconds.time
@@ -25,7 +27,6 @@ for trade_with_seconds in trade_objs_2:
 
 trades = [x.to_odict() for x in trade_objs_1]
 
-with open(sys.argv[3], 'w') as output_file:
-    json.dump(trades, output_file, indent=4)
+write_json(trades, args[2], 'compact' if '--compact' in sys.argv else None)
 
 print("Success. Exported {} items.".format(len(trades)))
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the tax engine once per cost basis method (FIFO, LIFO, HIFO) and writes a side-by-side
+summary of realized gains per tax year and currency, plus the full transaction file per method.
+
+The input is parsed and sorted, and its transfers linked, once in the parent process. Each method
+is replayed in its own worker process; forked workers share the parent's trades copy-on-write.
+Where workers are spawned instead of forked, each of them reads the input itself.
+
+Output files:
+
+ - `<output_prefix>.<method>.csv`: transactions, same format as generate_tax_report.py
+ - `<output_prefix>.summary.csv`: gain, short term gain and long term gain per method
+"""
+import csv
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+
+from generate_tax_report import GAINS_FIELDS, Ledger, TransactionSpool, find_transfers
+from lots import METHODS
+from tools import open_file, read_trades_from_file, convert_trade_objs
+
+
+# Sorted trades and their transfer links, set by `main` before the worker processes are created.
+_trade_objs = None
+_transfers = None
+
+
+def load(input_filename):
+    """
+    Reads, sorts and links the trades into the module globals shared with the workers.
+    """
+    global _trade_objs, _transfers
+    _trade_objs = sorted(convert_trade_objs(read_trades_from_file(input_filename)))
+    _transfers = find_transfers(_trade_objs)
+
+
+def run_method(method, input_filename, output_prefix):
+    """
+    Replays the shared trade stream with one cost basis method. Runs in a worker process.
+    :param input_filename: Only read if the worker was not forked from a parent that already did.
+    :type input_filename: str
+    :return: method and its gains, see `Rollups.gains`
+    :rtype: (str, dict)
+    """
+    if _trade_objs is None:
+        load(input_filename)
+    with TransactionSpool(f"{output_prefix}.{method.lower()}.csv") as transaction_spool:
+        ledger = Ledger(method, transaction_spool)
+        ledger.process_trades(_trade_objs, transfers=_transfers)
+    return method, ledger.rollups.gains()
+
+
+def write_summary(filename, summaries, methods):
+    keys = sorted(set(key for summary in summaries.values() for key in summary),
+                  key=lambda key: (key[0], key[1] != "ALL", key[1]))
+    fieldnames = ['tax_year', 'currency'] + [f"{method.lower()}_{field}" for method in methods
+                                             for field in GAINS_FIELDS]
+    with open_file(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        for key in keys:
+            row = OrderedDict([('tax_year', key[0]), ('currency', key[1])])
+            for method in methods:
+                totals = summaries[method].get(key, [Decimal(0)] * 5 + [0])
+                for field, value in zip(GAINS_FIELDS, totals):
+                    row[f"{method.lower()}_{field}"] = '{0:f}'.format(value) if isinstance(value, Decimal) else value
+            writer.writerow(row)
+    return keys
+
+
+def main():
+    if len(sys.argv) not in (3, 4):
+        print(f"Usage: {sys.argv[0]} <json_or_csv_file> <output_prefix> [methods, default {','.join(METHODS)}]")
+        exit(1)
+
+    methods = sys.argv[3].upper().split(',') if len(sys.argv) == 4 else list(METHODS)
+    for method in methods:
+        if method not in METHODS:
+            print(f"Unknown cost basis method: {method}")
+            exit(1)
+
+    output_prefix = sys.argv[2]
+    load(sys.argv[1])
+
+    summaries = {}
+    with ProcessPoolExecutor(max_workers=len(methods)) as executor:
+        futures = [executor.submit(run_method, method, sys.argv[1], output_prefix) for method in methods]
+        for future in futures:
+            method, summary = future.result()
+            summaries[method] = summary
+
+    keys = write_summary(f"{output_prefix}.summary.csv", summaries, methods)
+
+    print("tax_year  " + "".join(f"{method + ' gain':>24}{'short':>20}{'long':>20}" for method in methods))
+    for key in keys:
+        if key[1] != "ALL":
+            continue
+        line = f"{key[0]:<10}"
+        for method in methods:
+            totals = summaries[method].get(key, [Decimal(0)] * 5 + [0])
+            line += f"{totals[2]:>24.2f}{totals[3]:>20.2f}{totals[4]:>20.2f}"
+        print(line)
+
+    print(f"Success. Compared {len(methods)} methods over {len(_trade_objs)} trades.")
+
+
+if __name__ == '__main__':
+    main()
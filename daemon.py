@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+Keeps a trade dataset and the tax engine's state in memory and answers queries over
+localhost http, so ad-hoc reconciliation does not pay for a full load and replay every time.
+
+The source file is watched and re-read when it changes. Only the trades appended to it are
+converted and applied to the indexes and the tax engine's state; any other change (edits,
+removals, trades inserted before already processed ones) triggers a full reload.
+
+Transfers are linked like in generate_tax_report.py. Legs that are still unpaired are linked again
+when trades are appended. A withdrawal or deposit whose partner may still be appended holds back
+the trades from its time on (`queued` in /status) until the partner or a trade more than the
+transfer window later is appended.
+
+Queries (all return json):
+
+    /status
+    /duplicates
+    /unmatched
+    /balances
+    /gains[?year=2017]
+    /lots[?exchange=Kraken&currency=BTC]
+
+Usage:
+
+    python daemon.py data/combined.json [--port 8765] [--poll 2]
+"""
+import argparse
+import os
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+import codec
+from find_duplicates import DuplicateIndex
+from find_unmatched_movements import match_movements
+from diagnostics import Diagnostics
+from generate_tax_report import GAINS_FIELDS, DiscardSpool, Ledger, find_transfers, is_cancelled
+from lots import METHODS
+from price_index import PriceStore
+from tools import read_trades_from_file, convert_trade_objs
+from transfers import DEFAULT_WINDOW, TransferLinks
+
+
+class TradeState(object):
+    """
+    In-memory trades and derived state for one source file.
+    """
+
+    def __init__(self, filename, method='FIFO', price_store=None):
+        self.filename = filename
+        self.method = method
+        self.price_store = price_store
+        self.lock = threading.Lock()
+        self.stat = None
+        self.loaded_at = None
+        self.full_loads = 0
+        self.incremental_loads = 0
+        self.failed_stat = None
+        self.error = None
+        self._reset()
+
+    def _reset(self):
+        self.num_records = 0
+        self.first_record = None
+        self.last_record = None
+        self.trade_objs = []
+        self.duplicates = DuplicateIndex()
+        self.movements_by_time = {}
+        self.ledger, self.transfers = self._new_engine()
+        self.queued = []
+
+    def _new_engine(self):
+        # Samples are kept for /status, not printed on every reload.
+        ledger = Ledger(self.method, DiscardSpool(), Diagnostics(echo=False), price_store=self.price_store)
+        return ledger, TransferLinks([], [])
+
+    def _file_stat(self):
+        stat = os.stat(self.filename)
+        return stat.st_mtime_ns, stat.st_size
+
+    def refresh(self):
+        """
+        Reloads the source file if it changed. If loading fails, e.g. because the tax engine stops on
+        a data error, the previous state is kept and this version of the file is not tried again.
+        :return: True if anything was (re)loaded
+        :rtype: bool
+        """
+        stat = self._file_stat()
+        if stat == self.stat or stat == self.failed_stat:
+            return False
+        try:
+            self._load(stat)
+        # The engine calls exit(1) on data errors, which must not take the watcher down.
+        except (Exception, SystemExit) as e:
+            self.failed_stat = stat
+            self.error = repr(e)
+            raise
+        self.failed_stat = None
+        self.error = None
+        return True
+
+    def _load(self, stat):
+        """
+        Applies appended trades to the current engine state. A full reload builds the new state next
+        to the current one, which answers queries in the meantime, and swaps it in when done.
+        """
+        records = list(read_trades_from_file(self.filename))
+        appended = self._appended_records(records)
+        new_trades = sorted(convert_trade_objs(records if appended is None else appended))
+        if appended is not None and self.trade_objs and new_trades and new_trades[0] < self.trade_objs[-1]:
+            # Appended trades go back in time, the replay has to start over.
+            appended = None
+            new_trades = sorted(convert_trade_objs(records))
+
+        if appended is None:
+            ledger, transfers = self._new_engine()
+            queued = self._advance(ledger, transfers, [], new_trades)
+            with self.lock:
+                self._reset()
+                self.ledger, self.transfers, self.queued = ledger, transfers, queued
+                self._add(new_trades, records, stat)
+                self.full_loads += 1
+            return
+
+        with self.lock:
+            try:
+                self.queued = self._advance(self.ledger, self.transfers, self.queued, new_trades)
+            except (Exception, SystemExit):
+                # The ledger stopped half way through the new trades: rebuild it from the ones it had.
+                self.ledger, self.transfers = self._new_engine()
+                self.queued = self._advance(self.ledger, self.transfers, [], self.trade_objs)
+                raise
+            self._add(new_trades, records, stat)
+            self.incremental_loads += 1
+
+    def _advance(self, ledger, transfers, queued, new_trades):
+        """
+        Links the withdrawals and deposits among the queued and new trades that are not linked yet and
+        runs the trades through the ledger. A withdrawal or deposit without partner whose partner may
+        still be appended (it is within the transfer window of the latest trade) holds back itself and
+        all later trades until the next load.
+        :param queued: Trades held back by the previous call.
+        :type queued: list<Trade>
+        :param new_trades: Trades sorted by time, none before the queued ones.
+        :type new_trades: list<Trade>
+        :return: the trades held back
+        :rtype: list<Trade>
+        """
+        trade_objs = queued + new_trades
+        if not trade_objs:
+            return []
+        unlinked = [trade for trade in trade_objs
+                    if (trade.type == 'Withdrawal' or trade.type == 'Deposit') and not transfers.is_linked(trade)]
+        transfers.update(find_transfers(unlinked))
+        latest = trade_objs[-1].time
+        waiting = [trade.time for trade in unlinked if not transfers.is_linked(trade) and not is_cancelled(trade)
+                   and (latest - trade.time).total_seconds() <= DEFAULT_WINDOW]
+        until = min(waiting) if waiting else None
+        ledger.process_trades(trade_objs, until, transfers)
+        return [trade for trade in trade_objs if trade.time >= until] if until is not None else []
+
+    def _add(self, new_trades, records, stat):
+        self.trade_objs.extend(new_trades)
+        self.duplicates.add(new_trades)
+        for trade in new_trades:
+            if trade.type == 'Withdrawal' or trade.type == 'Deposit':
+                self.movements_by_time.setdefault(trade.time, []).append(trade)
+        self.num_records = len(records)
+        self.first_record = records[0] if records else None
+        self.last_record = records[-1] if records else None
+        self.stat = stat
+        self.loaded_at = time.time()
+
+    def _appended_records(self, records):
+        """
+        Returns the records added after the ones already loaded, or None if the file changed otherwise.
+        The loaded prefix is recognized by its first and last record.
+        """
+        if self.num_records == 0 or len(records) < self.num_records:
+            return None
+        if records[0] != self.first_record or records[self.num_records - 1] != self.last_record:
+            return None
+        return records[self.num_records:]
+
+    def query_status(self, params):
+        return OrderedDict([
+            ('filename', self.filename),
+            ('trades', len(self.trade_objs)),
+            ('transactions', self.ledger.transaction_count),
+            ('queued', len(self.queued)),
+            ('full_loads', self.full_loads),
+            ('incremental_loads', self.incremental_loads),
+            ('loaded_at', self.loaded_at),
+            ('error', self.error),
+            ('diagnostics', self.ledger.diagnostics.summary()),
+        ])
+
+    def query_duplicates(self, params):
+        return [d.to_odict() for d in self.duplicates.duplicates()]
+
+    def query_unmatched(self, params):
+        unmatched = []
+        ambiguous = []
+        for trade_time in sorted(self.movements_by_time):
+            group_unmatched, group_ambiguous = match_movements(self.movements_by_time[trade_time])
+            unmatched.extend(trade.to_odict() for trade in group_unmatched)
+            ambiguous.extend([trade.to_odict() for trade in finds] for finds in group_ambiguous)
+        return OrderedDict([('unmatched', unmatched), ('ambiguous', ambiguous)])
+
+    def query_balances(self, params):
+        return [position.to_odict() for position in self.ledger.open_lots().positions().values()]
+
+    def query_gains(self, params):
+        year = params.get('year')
+        gains = self.ledger.rollups.gains()
+        output = []
+        for key in sorted(gains, key=lambda key: (key[0], key[1] != "ALL", key[1])):
+            if year is not None and str(key[0]) != year:
+                continue
+            row = OrderedDict([('tax_year', key[0]), ('currency', key[1])])
+            for field, value in zip(GAINS_FIELDS, gains[key]):
+                row[field] = '{0:f}'.format(value) if isinstance(value, Decimal) else value
+            output.append(row)
+        return output
+
+    def query_lots(self, params):
+        open_lots = self.ledger.open_lots()
+        output = []
+        for (exchange, currency) in open_lots.keys():
+            if params.get('exchange', exchange) != exchange or params.get('currency', currency) != currency:
+                continue
+            output.extend(lot.to_odict() for lot in open_lots.lots(exchange, currency))
+        return output
+
+    def query(self, name, params):
+        handler = getattr(self, 'query_' + name, None)
+        if handler is None:
+            raise KeyError(name)
+        with self.lock:
+            return handler(params)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    Answers every request in its own thread (`http.server.ThreadingHTTPServer` needs Python 3.7).
+    """
+    daemon_threads = True
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            start = time.perf_counter()
+            try:
+                result = state.query(url.path.strip('/') or 'status', params)
+                status = 200
+            except KeyError:
+                result = {'error': f"Unknown query: {url.path}"}
+                status = 404
+            body = codec.dumps(result, indent=4).encode('utf8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-Query-Time', '{0:.6f}'.format(time.perf_counter() - start))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def watch(state, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            if state.refresh():
+                print(f"Reloaded {state.filename}: {len(state.trade_objs)} trades "
+                      f"({state.full_loads} full, {state.incremental_loads} incremental loads).")
+        except (Exception, SystemExit) as e:
+            # The file may be in the middle of being written; it is tried again once it changes.
+            print(f"Reload of {state.filename} failed: {e!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves queries over an in-memory trade dataset.")
+    parser.add_argument('input', metavar='json_or_csv_file')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--poll', type=float, default=2, help="seconds between checks of the source file")
+    parser.add_argument('--method', choices=METHODS, default='FIFO', help="cost basis method (default: FIFO)")
+    parser.add_argument('--prices', metavar='price_index', help="price index used to fill in missing usd values")
+    args = parser.parse_args()
+
+    price_store = PriceStore.open(args.prices) if args.prices else None
+    state = TradeState(args.input, args.method, price_store)
+    state.refresh()
+    print(f"Loaded {len(state.trade_objs)} trades from {args.input}.")
+
+    threading.Thread(target=watch, args=(state, args.poll), daemon=True).start()
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(state))
+    print(f"Listening on http://127.0.0.1:{args.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
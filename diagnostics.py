@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Collects data problems found by the tax engine, and the places where it had to fill in data.
+
+Every problem is reported as a typed event. Events are counted per category, the first few of
+each category are kept as samples (and printed), and all of them can be streamed to a json
+lines file. Context that is expensive to render, like a balance's transaction history, is
+passed as a callable and only rendered when a sample is printed or the stream asks for it.
+"""
+import sys
+from collections import Counter, OrderedDict
+
+import codec
+
+
+UNMATCHED_DISPOSAL = 'unmatched_disposal'
+MISMATCHED_TRANSFER = 'mismatched_transfer'
+MISSING_BASIS = 'missing_basis'
+UNACCOUNTED_TRADE_TYPE = 'unaccounted_trade_type'
+FILLED_BASIS = 'filled_basis'
+APPROXIMATE_TRANSFER = 'approximate_transfer'
+
+CATEGORIES = (UNMATCHED_DISPOSAL, MISMATCHED_TRANSFER, MISSING_BASIS, UNACCOUNTED_TRADE_TYPE, FILLED_BASIS,
+              APPROXIMATE_TRANSFER)
+
+
+class Event(object):
+    """
+    A single diagnostics event.
+    """
+    __slots__ = ('category', 'message', 'fields', '_context', '_rendered')
+
+    def __init__(self, category, message, fields, context=None):
+        self.category = category
+        self.message = message
+        self.fields = fields
+        self._context = context
+        self._rendered = None
+
+    def context(self):
+        """
+        Renders the event's context on first use.
+        :rtype: str|None
+        """
+        if self._rendered is None and self._context is not None:
+            self._rendered = str(self._context())
+            self._context = None
+        return self._rendered
+
+    def to_odict(self, with_context=False):
+        output = OrderedDict([('category', self.category), ('message', self.message)])
+        output.update(self.fields)
+        if with_context:
+            output['context'] = self.context()
+        return output
+
+    def __str__(self):
+        lines = [f"{self.category}: {self.message}"]
+        lines.extend(f"{key}: {value}" for key, value in self.fields.items())
+        context = self.context()
+        if context is not None:
+            lines.append(f"context: {context}")
+        return "\n".join(lines)
+
+
+class Diagnostics(object):
+    """
+    Counts events per category, keeps capped samples and optionally streams events as json lines.
+    """
+
+    def __init__(self, max_samples=5, stream=None, stream_context=False, echo=True):
+        """
+        :param max_samples: Number of events kept (and printed) per category.
+        :type max_samples: int
+        :param stream: Optional file object that receives every event as a json line.
+        :param stream_context: Render and include the context of every streamed event. Expensive.
+        :type stream_context: bool
+        :param echo: Print samples to stdout as they occur.
+        :type echo: bool
+        """
+        self.max_samples = max_samples
+        self.stream = stream
+        self.stream_context = stream_context
+        self.echo = echo
+        self.counters = Counter()
+        self.samples = {}
+
+    def report(self, category, message, context=None, **fields):
+        """
+        Reports an event. Field values should be cheap to compute; anything expensive belongs in `context`.
+        :param category: One of CATEGORIES.
+        :type category: str
+        :param message: Short description.
+        :type message: str
+        :param context: Optional callable returning additional detail, only called when needed.
+        :type context: callable
+        """
+        self.counters[category] += 1
+        count = self.counters[category]
+        if count > self.max_samples and self.stream is None:
+            return
+
+        event = Event(category, message, fields, context)
+        if count <= self.max_samples:
+            self.samples.setdefault(category, []).append(event)
+            if self.echo:
+                print(event)
+                print("--------------------------------")
+                if count == self.max_samples:
+                    print(f"Further {category} events are only counted.")
+                    print("--------------------------------")
+        if self.stream is not None:
+            self.stream.write(codec.dumps(event.to_odict(self.stream_context), default=str) + "\n")
+
+    def __len__(self):
+        return sum(self.counters.values())
+
+    def summary(self):
+        """
+        :return: event counts per category
+        :rtype: OrderedDict
+        """
+        return OrderedDict((category, self.counters[category]) for category in sorted(self.counters))
+
+    def print_summary(self, file=sys.stdout):
+        if not self.counters:
+            return
+        print("Diagnostics:", file=file)
+        for category, count in self.summary().items():
+            print(f"  {category}: {count}", file=file)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Compares two trade exports, e.g. yesterday's and today's, and writes what changed.
+
+Trades are matched by a digest of their key fields (see `Trade.key_digest`), so the exports may
+list trades in any order. A matched trade whose other fields (comment, group, usd values, ...)
+differ is reported as changed, with the old and new value of every changed field.
+
+Both exports are streamed once into hash-partitioned bucket files in a temporary directory and
+then compared one bucket at a time, so memory use is bounded by the size of a bucket rather
+than the size of the exports.
+
+The changeset is written as json lines, one change per line:
+
+    {"change": "added", "key": "<key digest>", "trade": {...}}
+    {"change": "removed", "key": "<key digest>", "trade": {...}}
+    {"change": "changed", "key": "<key digest>", "fields": {"comment": ["old", "new"]}, "trade": {...}}
+
+Usage:
+
+    python diff_exports.py data/saved.old.json data/saved.json data/changes.jsonl [--buckets 64]
+"""
+import argparse
+import os
+import tempfile
+from collections import Counter, OrderedDict
+
+import codec
+from tools import Trade, open_file, read_trades_from_file, iter_trade_objs
+
+
+OLD = 'old'
+NEW = 'new'
+
+
+def partition(filename, side, buckets):
+    """
+    Appends every trade of an export to the bucket its key digest falls into.
+    :param buckets: bucket files
+    :type buckets: list
+    :return: number of trades
+    :rtype: int
+    """
+    count = 0
+    for trade in iter_trade_objs(read_trades_from_file(filename, stream=True)):
+        key = trade.key_digest()
+        line = codec.dumps([side, key, trade.record_digest(), trade.canonical_values()], compact=True)
+        buckets[int(key[:8], 16) % len(buckets)].write(line + '\n')
+        count += 1
+    return count
+
+
+def changed_fields(old_values, new_values):
+    return OrderedDict((field, [old, new]) for field, old, new in zip(Trade.FIELDS, old_values, new_values)
+                       if old != new)
+
+
+def diff_bucket(f):
+    """
+    Compares the old and new trades of one bucket.
+    Trades with the same key (duplicates) are paired up: identical records first, then the rest in file order.
+    :return: changes
+    :rtype: generator
+    """
+    by_key = {}
+    for line in f:
+        side, key, record, values = codec.loads(line)
+        by_key.setdefault(key, ([], []))[side == NEW].append((record, values))
+
+    for key in sorted(by_key):
+        old, new = by_key[key]
+        unmatched = Counter(record for record, _ in new)
+        old = [entry for entry in old if not _take(unmatched, entry[0])]
+        matched = Counter(record for record, _ in new) - unmatched
+        new = [entry for entry in new if not _take(matched, entry[0])]
+
+        for (_, old_values), (_, new_values) in zip(old, new):
+            yield OrderedDict([('change', 'changed'), ('key', key),
+                               ('fields', changed_fields(old_values, new_values)),
+                               ('trade', OrderedDict(zip(Trade.FIELDS, new_values)))])
+        for _, values in new[len(old):]:
+            yield OrderedDict([('change', 'added'), ('key', key), ('trade', OrderedDict(zip(Trade.FIELDS, values)))])
+        for _, values in old[len(new):]:
+            yield OrderedDict([('change', 'removed'), ('key', key), ('trade', OrderedDict(zip(Trade.FIELDS, values)))])
+
+
+def _take(counter, record):
+    """
+    Takes one `record` from `counter` if there is one left.
+    """
+    if counter[record] > 0:
+        counter[record] -= 1
+        return True
+    return False
+
+
+def diff_exports(old_filename, new_filename, num_buckets=64, directory=None):
+    """
+    Compares two exports.
+    :param num_buckets: Number of bucket files. More buckets mean less memory per bucket.
+    :type num_buckets: int
+    :param directory: Directory for the temporary bucket files, default is the system's temp directory.
+    :type directory: str
+    :return: changes, and the number of trades per side once all changes have been consumed
+    :rtype: (generator, dict)
+    """
+    counts = {}
+
+    def changes():
+        with tempfile.TemporaryDirectory(prefix='diff_exports.', dir=directory) as tmp:
+            filenames = [os.path.join(tmp, f"{i}.jsonl") for i in range(num_buckets)]
+            buckets = [open_file(filename, 'w') for filename in filenames]
+            try:
+                counts[OLD] = partition(old_filename, OLD, buckets)
+                counts[NEW] = partition(new_filename, NEW, buckets)
+            finally:
+                for bucket in buckets:
+                    bucket.close()
+            for filename in filenames:
+                with open_file(filename) as f:
+                    yield from diff_bucket(f)
+
+    return changes(), counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes the trades added, removed and changed between two exports.")
+    parser.add_argument('old', metavar='old_json_or_csv_file')
+    parser.add_argument('new', metavar='new_json_or_csv_file')
+    parser.add_argument('output', metavar='changes_jsonl')
+    parser.add_argument('--buckets', type=int, default=64, help="number of temporary bucket files (default: 64)")
+    parser.add_argument('--tmp-dir', help="directory for the bucket files")
+    args = parser.parse_args()
+
+    changes, counts = diff_exports(args.old, args.new, args.buckets, args.tmp_dir)
+    totals = Counter()
+    with open_file(args.output, 'w') as f:
+        for change in changes:
+            totals[change['change']] += 1
+            f.write(codec.dumps(change, compact=True) + '\n')
+
+    print(f"Compared {counts[OLD]} old and {counts[NEW]} new trades.")
+    print(f"Success. {totals['added']} added, {totals['removed']} removed, {totals['changed']} changed.")
+
+
+if __name__ == '__main__':
+    main()
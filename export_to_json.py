@@ -3,15 +3,21 @@
 Simple script that exports all trades from cointracking and write them into a json file.
 
 Note that the exported json is NOT compatible with the json export from the cointracking site.
+
+The output is compressed if the filename ends in `.gz`, `.xz` or `.zst` and written as json lines
+if it ends in `.jsonl`. `--compact` writes json without indentation.
+`--progress` prints API request times to stderr, `--metrics <file>` writes them as json.
 """
-import json
 import sys
 
+import telemetry
 from api import get_trades
+from tools import write_json
 
 
-if len(sys.argv) != 2:
-    print("Usage: {} <json_file>".format(sys.argv[0]))
+args = telemetry.setup_from_argv([arg for arg in sys.argv[1:] if arg != '--compact'])
+if len(args) != 1:
+    print("Usage: {} <json_file> [--compact] [--progress] [--metrics <metrics_json>]".format(sys.argv[0]))
     exit(1)
 
 all_trades = get_trades()
@@ -19,7 +25,6 @@ all_trades = get_trades()
 for key in ["success", "method"]: del all_trades[key]
 all_trades = list(all_trades.values())
 
-with open(sys.argv[1], 'w') as output_file:
-    json.dump(all_trades, output_file, indent=4)
+write_json(all_trades, args[0], 'compact' if '--compact' in sys.argv else None)
 
 print("Success. Exported {} items.".format(len(all_trades)))
@@ -9,40 +9,66 @@ occur when trading on exchanges.
 You can mark a duplicate entry as acceptable by adding `dupok` to the entry's comment.
 
 This script works on a json export as the API has rather low request limits.
+
+Duplicates are written as they are found, see `--format` and `--summary-only`.
 """
-import sys
-from tools import prettify, read_trades_from_file, convert_trade_objs
+import argparse
+from tools import FindingWriter, read_trades_from_file, iter_trade_objs
+
+
+class DuplicateIndex(object):
+    """
+    Keeps track of duplicate trades. Trades can be added incrementally.
+    """
+
+    def __init__(self):
+        self.seen = set()  # seen values
+        self.dupl = set()  # values listed in duplist
+        self.duplist = []  # result
 
+    def add(self, seq):
+        for x in seq:
+            self.add_one(x)
 
-if len(sys.argv) != 2:
-    print("Usage: {} <json_or_csv_file>".format(sys.argv[0]))
-    exit(1)
+    def add_one(self, x):
+        """
+        Adds a trade. Returns True if it is the first duplicate of an already seen trade.
+        """
+        if x in self.seen and x not in self.dupl:
+            self.duplist.append(x)
+            self.dupl.add(x)
+            return True
+        self.seen.add(x)
+        return False
 
-all_trades = read_trades_from_file(sys.argv[1])
+    def duplicates(self):
+        """
+        Returns duplicates that have not been marked as being ok.
+        """
+        return [d for d in self.duplist if 'dupok' not in d.comment]
 
-trade_objs = convert_trade_objs(all_trades)
 
+def main():
+    parser = argparse.ArgumentParser(description="Finds duplicate entries.")
+    parser.add_argument('input', metavar='json_or_csv_file')
+    parser.add_argument('--format', choices=FindingWriter.FORMATS, default='pretty', help="output format")
+    parser.add_argument('--summary-only', action='store_true', help="only print the number of duplicates")
+    args = parser.parse_args()
 
-def list_duplicates(seq):
-    seen = set()  # seen values
-    dupl = set()  # values listed in duplist
-    duplist = []  # result
-    for x in seq:
-        if x in seen and x not in dupl:
-            duplist.append(x)
-            dupl.add(x)
-        else:
-            seen.add(x)
-    return duplist
+    writer = FindingWriter(args.format, summary_only=args.summary_only)
+    index = DuplicateIndex()
+    num_trades = 0
+    for trade in iter_trade_objs(read_trades_from_file(args.input), lazy=True):
+        num_trades += 1
+        # Ignore duplicates that have been marked as being ok.
+        if index.add_one(trade) and 'dupok' not in trade.comment:
+            writer.write('duplicate', [trade])
 
-output = []
-for d in list_duplicates(trade_objs):
-    # Ignore duplicates that have been marked as being ok.
-    if 'dupok' not in d.comment:
-        output.append(d.to_odict())
+    writer.write_summary([
+        "Checked {} transactions.".format(num_trades),
+        "Found {} duplicates.".format(writer.counts['duplicate']),
+    ])
 
-if len(output):
-    print(prettify(output, indent=4))
 
-print("Checked {} transactions.".format(len(trade_objs)))
-print("Found {} duplicates.".format(len(output)))
+if __name__ == '__main__':
+    main()
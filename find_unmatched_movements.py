@@ -5,18 +5,12 @@ Essentially, this script verify the consistency of double-entry-bookkeeping.
 Very useful.
 
 This script works on a json export as the API has rather low request limits.
-"""
-import sys
-from tools import prettify, read_trades_from_file, convert_trade_objs
-
-
-if len(sys.argv) != 2:
-    print("Usage: {} <json_or_csv_file>".format(sys.argv[0]))
-    exit(1)
 
-all_trades = read_trades_from_file(sys.argv[1])
-
-trade_objs = sorted(convert_trade_objs(all_trades))
+Unmatched movements are written as they are found, see `--format` and `--summary-only`.
+"""
+import argparse
+from itertools import groupby
+from tools import FindingWriter, read_trades_from_file, convert_trade_objs
 
 
 def do_movements_match(trade1, trade2):
@@ -48,41 +42,58 @@ def do_movements_match(trade1, trade2):
 
     return True
 
-num_unmatched = 0
-
-for i in range(0, len(trade_objs)):
-    trade = trade_objs[i]
-    
-    if trade.type != 'Withdrawal' and trade.type != 'Deposit':
-        continue
-
-    finds = [trade]
-
-    # step backwards
-    j = i - 1
-    while j >= 0 and trade_objs[j].time == trade.time:
-        if do_movements_match(trade_objs[j], trade):
-            finds.append(trade_objs[j])
-        j -= 1
-
-    # step forwards
-    j = i + 1
-    while j < len(trade_objs) and trade_objs[j].time == trade.time:
-        if do_movements_match(trade_objs[j], trade):
-            finds.append(trade_objs[j])
-        j += 1
-
-    if len(finds) == 1:
-        print("Found no match for the following movement:")
-        print(prettify(finds[0].to_odict()))
-        num_unmatched += 1
-
-    if len(finds) > 2:
-        print("Found too many matches for the movement.")
-        print("Check for duplicates!")
-        for found in finds:
-            print(prettify(found.to_odict()))
-        # num_unmatched += 1
-
-print("Checked {} transactions.".format(len(trade_objs)))
-print("Found {} unmatched movements.".format(num_unmatched))
+
+def match_movements(trades):
+    """
+    Matches movements that happened at the same time.
+    :param trades: Trades with identical time.
+    :type trades: list<Trade>
+    :return: movements without a match, and groups of movements with too many matches
+    :rtype: (list<Trade>, list<list<Trade>>)
+    """
+    unmatched = []
+    ambiguous = []
+    for i in range(0, len(trades)):
+        trade = trades[i]
+
+        if trade.type != 'Withdrawal' and trade.type != 'Deposit':
+            continue
+
+        finds = [trade]
+        for j in range(0, len(trades)):
+            if j != i and do_movements_match(trades[j], trade):
+                finds.append(trades[j])
+
+        if len(finds) == 1:
+            unmatched.append(trade)
+
+        if len(finds) > 2:
+            ambiguous.append(finds)
+    return unmatched, ambiguous
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Finds movements without a matching movement in the other direction.")
+    parser.add_argument('input', metavar='json_or_csv_file')
+    parser.add_argument('--format', choices=FindingWriter.FORMATS, default='pretty', help="output format")
+    parser.add_argument('--summary-only', action='store_true', help="only print the number of unmatched movements")
+    args = parser.parse_args()
+
+    trade_objs = sorted(convert_trade_objs(read_trades_from_file(args.input)))
+
+    writer = FindingWriter(args.format, summary_only=args.summary_only)
+    for _, group in groupby(trade_objs, key=lambda trade: trade.time):
+        unmatched, ambiguous = match_movements(list(group))
+        for trade in unmatched:
+            writer.write('unmatched', [trade], "Found no match for the following movement:")
+        for finds in ambiguous:
+            writer.write('ambiguous', finds, "Found too many matches for the movement.\nCheck for duplicates!")
+
+    writer.write_summary([
+        "Checked {} transactions.".format(len(trade_objs)),
+        "Found {} unmatched movements.".format(writer.counts['unmatched']),
+    ])
+
+
+if __name__ == '__main__':
+    main()
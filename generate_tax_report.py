@@ -1,17 +1,28 @@
 # -*- coding: utf-8 -*-
+import argparse
 import csv
-import json
-import sys
-from collections import OrderedDict
-from dateutil.relativedelta import relativedelta
-from tools import read_trades_from_file, convert_trade_objs
+import heapq
+import itertools
+import os
+from collections import OrderedDict, deque, namedtuple
+from datetime import datetime
+from decimal import Decimal
 
+import codec
+import telemetry
+from diagnostics import Diagnostics, APPROXIMATE_TRANSFER, FILLED_BASIS, MISMATCHED_TRANSFER, MISSING_BASIS, \
+    UNACCOUNTED_TRADE_TYPE, UNMATCHED_DISPOSAL
+from lots import METHODS, OpenLots, is_long_term
+from price_index import PriceStore
+from transfers import DEFAULT_WINDOW, link_transfers, movement_key
+from tools import open_file, read_trades_from_file, convert_trade_objs, split_compression, write_json
 
-if len(sys.argv) != 3:
-    print(f"Usage: {sys.argv[0]} <json_or_csv_file> <output_csv>")
-    exit(1)
 
-trade_objs = sorted(convert_trade_objs(read_trades_from_file(sys.argv[1])))
+# Number of recent transactions a balance keeps for diagnostics when transactions are spooled to disk.
+SPOOL_RECENT_TRANSACTIONS = 10
+
+TransactionSummary = namedtuple('TransactionSummary', ['amount', 'currency', 'basis', 'proceeds', 'buy_time', 'sell_time'])
+
 
 class Transaction(object):
     def __init__(self, amount, buy_basis, sell_basis, buy_trade, sell_trade, comment=""):
@@ -26,7 +37,7 @@ class Transaction(object):
         return str(self.to_odict())
 
     def __repr__(self):
-        return json.dumps(self.to_odict())
+        return codec.dumps(self.to_odict())
 
     fieldnames = ['amount', 'currency', 'basis', 'proceeds', 'gain', 'buy_time', 'sell_time', 'tax_year', 'time_held', 'is_long', 'buy_exchange', 'sell_exchange', 'comment']
 
@@ -46,13 +57,128 @@ class Transaction(object):
             ('sell_time', self.sell_trade.time.isoformat()),
             ('tax_year', self.sell_trade.time.year),
             ('time_held', str(self.sell_trade.time - self.buy_trade.time)),
-            ('is_long', (self.sell_trade.time >= (self.buy_trade.time + relativedelta(days=365)))), # relativedelta(years=1)
+            ('is_long', is_long_term(self.buy_trade.time, self.sell_trade.time)),
             ('buy_exchange', self.buy_trade.exchange),
             ('sell_exchange', self.sell_trade.exchange),
             ('comment', self.comment),
         ])
 
-transactions = []
+    def summary(self):
+        """
+        Returns the fields needed for diagnostics, without references to the trades.
+        :rtype: TransactionSummary
+        """
+        return TransactionSummary(self.amount, self.buy_trade.buy_currency, self.buy_basis, self.sell_basis,
+                                  self.buy_trade.time, self.sell_trade.time)
+
+
+def partition_filename(filename, tax_year):
+    """
+    Returns the filename of a tax year's partition, e.g. `report.csv.gz` -> `report.2017.csv.gz`.
+    """
+    base, compression = split_compression(filename)
+    root, extension = os.path.splitext(base)
+    return f"{root}.{tax_year}{extension}{filename[len(base):]}"
+
+
+def rollups_filename(filename):
+    """
+    Returns the filename of a report's rollups, e.g. `report.csv.gz` -> `report.rollups.csv.gz`.
+    """
+    return partition_filename(filename, 'rollups')
+
+
+def fills_filename(filename):
+    """
+    Returns the filename of a report's filled bases, e.g. `report.csv.gz` -> `report.filled_basis.csv.gz`.
+    """
+    return partition_filename(filename, 'filled_basis')
+
+
+class TransactionSpool(object):
+    """
+    Writes transactions to a csv file as soon as they are realized, so they are not kept in memory.
+    With `partition`, every tax year goes to its own file (see `partition_filename`).
+    """
+
+    def __init__(self, filename, partition=False):
+        self.filename = filename
+        self.partition = partition
+        self.filenames = []
+        self.file = None
+        self.writer = None
+        self.tax_year = None
+        self.count = 0
+        if not partition:
+            self._open(filename)
+
+    def _open(self, filename):
+        if self.file is not None:
+            self.file.close()
+        self.file = open_file(filename, 'w', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=Transaction.fieldnames)
+        self.writer.writeheader()
+        self.filenames.append(filename)
+
+    def append(self, transaction):
+        if self.partition and transaction.sell_trade.time.year != self.tax_year:
+            # Transactions come in order of sale, so a tax year's file is complete once the next one starts.
+            self.tax_year = transaction.sell_trade.time.year
+            self._open(partition_filename(self.filename, self.tax_year))
+        self.writer.writerow(transaction.to_odict())
+        self.count += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class DiscardSpool(object):
+    """
+    Drops transactions as they are realized, for callers that only need the rollups and open lots.
+    """
+
+    def append(self, transaction):
+        pass
+
+
+class FillLog(object):
+    """
+    Writes every basis that was filled in from local prices to a csv file, with the price used and
+    where it came from.
+    """
+    fieldnames = ['trade_id', 'time', 'leg', 'currency', 'price', 'basis', 'price_method', 'price_times']
+
+    def __init__(self, filename):
+        self.file = open_file(filename, 'w', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=self.fieldnames)
+        self.writer.writeheader()
+        self.count = 0
+
+    def append(self, fill):
+        row = dict(fill)
+        row['price_times'] = ' '.join(str(source_time) for source_time in fill['price_times'])
+        self.writer.writerow(row)
+        self.count += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
 
 class BalanceEntry(object):
     def __init__(self, buy_trade, basis, amount):
@@ -80,6 +206,9 @@ class BalanceEntry(object):
     def is_depleted(self):
         return self.amount_remaining == 0
 
+    def unit_basis(self):
+        return self.basis / self.amount_remaining if self.amount_remaining else Decimal(0)
+
     def remove_amount(self, remove_amount):
         basis_removed = remove_amount * self.basis / self.amount_remaining
         self.amount_remaining = self.amount_remaining - remove_amount
@@ -91,129 +220,159 @@ class BalanceEntry(object):
 
 class Balance(object):
 
-    balances = {}
-    @classmethod
-    def get_balance(cls, exchange, currency):
-        if not (exchange, currency) in cls.balances:
-            cls.balances[(exchange, currency)] = Balance(exchange, currency)
-        return cls.balances[(exchange, currency)]
-        # if not currency in cls.balances:
-        #     cls.balances[currency] = Balance(exchange, currency)
-        # return cls.balances[currency]
-
-    def __init__(self, exchange, currency):
+    def __init__(self, ledger, exchange, currency):
+        self.ledger = ledger
         self.exchange = exchange
         self.currency = currency
-        self.balance_entries = []
-        self.transactions = []
+        # HIFO: a heap of (-unit basis, sequence number, entry). An entry's unit basis doesn't change
+        # when amounts are removed from it, so its place in the heap stays valid.
+        # FIFO and LIFO: a deque in the order the entries were added.
+        self.balance_entries = [] if self.method == 'HIFO' else deque()
+        self.sequence = itertools.count()
+        self.transactions = [] if ledger.spool is None else deque(maxlen=SPOOL_RECENT_TRANSACTIONS)
+
+    @property
+    def method(self):
+        return self.ledger.method
+
+    def add_entry(self, entry):
+        if self.method == 'HIFO':
+            heapq.heappush(self.balance_entries, (-entry.unit_basis(), next(self.sequence), entry))
+        else:
+            self.balance_entries.append(entry)
+
+    def next_entry(self):
+        """
+        Returns the balance entry to consume next according to the cost basis method.
+        """
+        if self.method == 'HIFO':
+            return self.balance_entries[0][2]
+        if self.method == 'LIFO':
+            return self.balance_entries[-1]
+        return self.balance_entries[0]
+
+    def pop_entry(self):
+        """
+        Removes the entry returned by `next_entry`.
+        """
+        if self.method == 'HIFO':
+            heapq.heappop(self.balance_entries)
+        elif self.method == 'LIFO':
+            self.balance_entries.pop()
+        else:
+            self.balance_entries.popleft()
+
+    def entries(self):
+        """
+        Returns the balance entries in the order they were added.
+        :rtype: list<BalanceEntry>
+        """
+        if self.method == 'HIFO':
+            return [entry for _, _, entry in sorted(self.balance_entries, key=lambda item: item[1])]
+        return list(self.balance_entries)
 
     def add_buy_trade(self, trade, basis):
-        self.balance_entries.append(BalanceEntry(trade, basis, trade.buy_amount))
+        self.add_entry(BalanceEntry(trade, basis, trade.buy_amount))
 
     def add_sell_trade(self, trade, basis):
+        record = self.ledger.records(trade)
         trade_amount_remaining = trade.sell_amount
         trade_basis_remaining = basis
         while trade_amount_remaining > 0 and len(self.balance_entries) > 0:
-            entry = self.balance_entries[0]
+            entry = self.next_entry()
             transaction_sell_amount = min(trade_amount_remaining, entry.amount_remaining)
             transaction_sell_basis = transaction_sell_amount * trade_basis_remaining / trade_amount_remaining
-            transaction = entry.sell(transaction_sell_amount, transaction_sell_basis, trade)
-            transactions.append(transaction)
-            self.transactions.append(transaction)
+            if record:
+                transaction = entry.sell(transaction_sell_amount, transaction_sell_basis, trade)
+                self.ledger.add_transaction(self, transaction)
+            else:
+                entry.remove_amount(transaction_sell_amount)
             trade_amount_remaining = trade_amount_remaining - transaction_sell_amount
             trade_basis_remaining = trade_basis_remaining - transaction_sell_basis
             if entry.is_depleted():
-                self.balance_entries.pop(0)
+                self.pop_entry()
 
         if trade_amount_remaining > 0:
             if trade_amount_remaining < 1E-5 or trade_basis_remaining < 1E-5:
                 # print(f"Skipping negligible add_sell_trade: {trade}")
                 pass
             else:
-                print("add_sell_trade error:")
-                print(f"Found no match for the following trade: {trade}")
-                print(f"trade_amount_remaining: {trade_amount_remaining}")
-                print(f"trade_basis_remaining: {trade_basis_remaining}")
-                print(f"Balance transactions: {self.transactions}")
-                print("--------------------------------")
+                self.report_unmatched('add_sell_trade', trade, trade_amount_remaining, trade_basis_remaining)
                 # exit(1)
 
     def add_deposit_entry(self, balance_entry):
-        self.balance_entries.append(balance_entry)
+        self.add_entry(balance_entry)
 
     def add_withdrawal_trade(self, trade, deposit_balance):
         trade_amount_remaining = trade.sell_amount
         while trade_amount_remaining > 0 and len(self.balance_entries) > 0:
-            entry = self.balance_entries[0]
+            entry = self.next_entry()
             transaction_trade_amount_remaining = min(trade_amount_remaining, entry.amount_remaining)
             balance_entry = entry.withdraw(transaction_trade_amount_remaining)
             deposit_balance.add_deposit_entry(balance_entry)
             trade_amount_remaining = trade_amount_remaining - transaction_trade_amount_remaining
             if entry.is_depleted():
-                self.balance_entries.pop(0)
+                self.pop_entry()
 
         if trade_amount_remaining > 0:
-            if trade_amount_remaining < 1E-5 or trade_basis_remaining < 1E-5:
+            if trade_amount_remaining < 1E-5:
                 # print(f"Skipping negligible add_withdrawal_trade: {trade}")
                 pass
             else:
-                print("add_withdrawal_trade error:")
-                print(f"Found no match for the following trade: {trade}")
-                print(f"trade_amount_remaining: {trade_amount_remaining}")
-                print(f"Balance transactions: {self.transactions}")
-                print("--------------------------------")
+                self.report_unmatched('add_withdrawal_trade', trade, trade_amount_remaining)
                 # exit(1)
 
     def add_spend_trade(self, trade, basis, comment=""):
+        record = self.ledger.records(trade)
         trade_amount_remaining = trade.sell_amount
         trade_basis_remaining = basis
         while trade_amount_remaining > 0 and len(self.balance_entries) > 0:
-            entry = self.balance_entries[0]
+            entry = self.next_entry()
             transaction_amount = min(trade_amount_remaining, entry.amount_remaining)
             transaction_basis = transaction_amount * trade_basis_remaining / trade_amount_remaining
-            transaction = entry.spend(transaction_amount, transaction_basis, trade, comment)
-            transactions.append(transaction)
-            self.transactions.append(transaction)
+            if record:
+                transaction = entry.spend(transaction_amount, transaction_basis, trade, comment)
+                self.ledger.add_transaction(self, transaction)
+            else:
+                entry.remove_amount(transaction_amount)
             trade_amount_remaining = trade_amount_remaining - transaction_amount
             trade_basis_remaining = trade_basis_remaining - transaction_basis
             if entry.is_depleted():
-                self.balance_entries.pop(0)
+                self.pop_entry()
 
         if trade_amount_remaining > 0:
             if trade_amount_remaining < 1E-5 or trade_basis_remaining < 1E-5:
                 # print(f"Skipping negligible add_spend_trade: {trade}")
                 pass
             else:
-                print("add_spend_trade error:")
-                print(f"Found no match for the following trade: {trade}")
-                print(f"trade_amount_remaining: {trade_amount_remaining}")
-                print(f"Balance transactions: {self.transactions}")
-                print("--------------------------------")
+                self.report_unmatched('add_spend_trade', trade, trade_amount_remaining, trade_basis_remaining)
                 # exit(1)
 
     def add_income_trade(self, trade, basis):
-        self.balance_entries.append(BalanceEntry(trade, basis, trade.buy_amount))
-
+        self.add_entry(BalanceEntry(trade, basis, trade.buy_amount))
 
-def validate_transfer(withdrawal, deposit):
-    if withdrawal.sell_currency != deposit.buy_currency:
-        print("validate_transfer error:")
-        print(withdrawal)
-        print(deposit)
-        print("--------------------------------")
-        exit(1)
+    def recent_transactions(self, count=SPOOL_RECENT_TRANSACTIONS):
+        return list(self.transactions)[-count:] if isinstance(self.transactions, deque) \
+            else self.transactions[-count:]
 
-def perform_transfer(withdrawal, deposit):
-    validate_transfer(withdrawal, deposit)
+    def report_unmatched(self, operation, trade, amount_remaining, basis_remaining=None):
+        recent = self.recent_transactions()
+        fields = dict(operation=operation, exchange=self.exchange, currency=self.currency,
+                      trade_id=trade.trade_id, time=trade.time.isoformat(),
+                      amount_remaining='{0:f}'.format(amount_remaining))
+        if basis_remaining is not None:
+            fields['basis_remaining'] = '{0:f}'.format(basis_remaining)
+        self.ledger.diagnostics.report(
+            UNMATCHED_DISPOSAL, "Found no match for the following trade",
+            context=lambda: f"trade: {trade}\nrecent balance transactions: {recent}", **fields)
 
-    currency = withdrawal.sell_currency
-    if currency == "USD":
-        return
-    withdrawal_balance = Balance.get_balance(withdrawal.exchange, currency)
-    deposit_balance = Balance.get_balance(deposit.exchange, currency)
 
-    withdrawal_balance.add_withdrawal_trade(withdrawal, deposit_balance)
+def is_cancelled(trade):
+    return "cancelled" in trade.comment.lower() or "failed" in trade.comment.lower() \
+        or "cancelled" in trade.group.lower() or "failed" in trade.group.lower()
 
+def validate_transfer(withdrawal, deposit):
+    return withdrawal.sell_currency == deposit.buy_currency
 
 def validate_basis(trade):
     if trade.buy_currency == "USD":
@@ -260,95 +419,535 @@ def determine_basis(trade):
     if trade.sell_value_usd != 0:
         return trade.sell_value_usd
 
-    print(f"determine_basis error: {trade}")
-    print("--------------------------------")
-
     # if trade.sell_value_usd != 0:
     #     return trade.sell_value_usd
 
-    exit(1)
+    return None
 
-def perform_trade(trade):
-    sell_balance = Balance.get_balance(trade.exchange, trade.sell_currency)
-    buy_balance = Balance.get_balance(trade.exchange, trade.buy_currency)
 
-    basis = determine_basis(trade)
+class Ledger(object):
+    """
+    The complete state of one run of the tax engine: balances per (exchange, currency) and the
+    realized transactions. Ledgers share no state, so several accounts or cost basis methods
+    can be processed in the same process.
+    """
 
-    if sell_balance.currency != "USD":
-        sell_balance.add_sell_trade(trade, basis)
-    if buy_balance.currency != "USD":
-        buy_balance.add_buy_trade(trade, basis)
-
-def perform_spend(trade, comment=""):
-    balance = Balance.get_balance(trade.exchange, trade.sell_currency)
-    basis = determine_basis(trade)
-    balance.add_spend_trade(trade, basis, comment)
+    def __init__(self, method='FIFO', spool=None, diagnostics=None, price_store=None, price_max_gap=86400,
+                 record_from=None, fill_log=None):
+        """
+        :param method: Cost basis method, one of FIFO, LIFO, HIFO.
+        :type method: str
+        :param spool: If set, transactions are handed to the spool instead of being kept in `transactions`.
+        :type spool: TransactionSpool
+        :param diagnostics: Collector for data problems. A default one is created if not given.
+        :type diagnostics: Diagnostics
+        :param price_store: Local prices used to value trades that have no usd value.
+        :type price_store: PriceStore
+        :param price_max_gap: Maximum distance in seconds to a known price when filling in a basis.
+        :type price_max_gap: int
+        :param record_from: Disposals before this time only update the lots, no transactions are created for them.
+        :type record_from: datetime
+        :param fill_log: If set, every basis filled in from local prices is also written to it.
+        :type fill_log: FillLog
+        """
+        if method not in METHODS:
+            raise ValueError(f"Unknown cost basis method: {method}")
+        self.method = method
+        self.spool = spool
+        self.diagnostics = diagnostics if diagnostics is not None else Diagnostics()
+        self.price_store = price_store
+        self.price_max_gap = price_max_gap
+        self.record_from = record_from
+        self.fill_log = fill_log
+        self.balances = {}
+        self.transactions = []
+        self.transaction_count = 0
+        self.rollups = Rollups()
+        self.pending_transfer = (None, None)
 
-def perform_income(trade):
-    balance = Balance.get_balance(trade.exchange, trade.buy_currency)
-    basis = determine_basis(trade)
-    balance.add_income_trade(trade, basis)
+    def records(self, trade):
+        """
+        Returns True if transactions should be created for a disposal.
+        """
+        return self.record_from is None or trade.time >= self.record_from
 
+    def add_transaction(self, balance, transaction):
+        self.transaction_count += 1
+        self.rollups.add_transaction(transaction)
+        if self.spool is None:
+            self.transactions.append(transaction)
+            balance.transactions.append(transaction)
+        else:
+            self.spool.append(transaction)
+            balance.transactions.append(transaction.summary())
 
+    def get_balance(self, exchange, currency):
+        if not (exchange, currency) in self.balances:
+            self.balances[(exchange, currency)] = Balance(self, exchange, currency)
+        return self.balances[(exchange, currency)]
 
-withdrawal = None
-deposit = None
+    def open_lots(self):
+        """
+        Returns the lots that are still open after processing, with their remaining basis.
+        :rtype: OpenLots
+        """
+        return OpenLots.from_balances(self.balances)
 
-for i in range(0, len(trade_objs)):
-    trade = trade_objs[i]
+    def determine_basis(self, trade, required=True):
+        """
+        Returns the trade's usd basis, filled in from local prices if the trade has none.
+        :param required: Stop if there is no basis. Otherwise report it and return None.
+        :type required: bool
+        :rtype: Decimal|None
+        """
+        basis = determine_basis(trade)
+        if basis is None and self.price_store is not None:
+            valuation = self.price_store.value_trade(trade, self.price_max_gap)
+            if valuation is not None:
+                basis, quote, leg = valuation
+                fill = OrderedDict([
+                    ('trade_id', trade.trade_id), ('time', trade.time.isoformat()), ('leg', leg),
+                    ('currency', quote.currency), ('price', '{0:f}'.format(quote.price)),
+                    ('basis', '{0:f}'.format(basis)), ('price_method', quote.method),
+                    ('price_times', list(quote.source_times)),
+                ])
+                self.diagnostics.report(FILLED_BASIS, "Filled in missing basis from local prices", **fill)
+                if self.fill_log is not None:
+                    self.fill_log.append(fill)
+        if basis is None and not required:
+            self.diagnostics.report(MISSING_BASIS, "Trade has no usd value and no local price, skipped",
+                                    trade_id=trade.trade_id, time=trade.time.isoformat(),
+                                    currency=trade.sell_currency or trade.buy_currency)
+        elif basis is None:
+            self.diagnostics.report(MISSING_BASIS, "Trade has no usd value to derive a basis from",
+                                    trade=str(trade))
+            exit(1)
+        return basis
 
-    if "cancelled" in trade.comment.lower() or "failed" in trade.comment.lower() \
-        or "cancelled" in trade.group.lower() or "failed" in trade.group.lower():
-        continue
+    def perform_transfer(self, withdrawal, deposit):
+        if not validate_transfer(withdrawal, deposit):
+            self.diagnostics.report(MISMATCHED_TRANSFER, "Withdrawal and deposit currencies differ",
+                                    withdrawal=str(withdrawal), deposit=str(deposit))
+            exit(1)
 
-    if trade.type == 'Withdrawal' or trade.type == 'Deposit':
-        if trade.type == 'Withdrawal':
-            withdrawal = trade
+        currency = withdrawal.sell_currency
+        if currency == "USD":
+            return
+        withdrawal_balance = self.get_balance(withdrawal.exchange, currency)
+        deposit_balance = self.get_balance(deposit.exchange, currency)
+
+        withdrawal_balance.add_withdrawal_trade(withdrawal, deposit_balance)
+
+    def report_approximate_transfer(self, withdrawal, deposit):
+        self.diagnostics.report(
+            APPROXIMATE_TRANSFER, "Withdrawal and deposit amounts differ, paired by currency",
+            context=lambda: f"withdrawal: {withdrawal}\ndeposit: {deposit}",
+            withdrawal_id=withdrawal.trade_id, deposit_id=deposit.trade_id, time=withdrawal.time.isoformat(),
+            currency=withdrawal.sell_currency, withdrawn='{0:f}'.format(movement_key(withdrawal)[1]),
+            deposited='{0:f}'.format(movement_key(deposit)[1]))
+
+    def perform_trade(self, trade, required=True):
+        basis = self.determine_basis(trade, required)
+        if basis is None:
+            return
+
+        sell_balance = self.get_balance(trade.exchange, trade.sell_currency)
+        buy_balance = self.get_balance(trade.exchange, trade.buy_currency)
+
+        if sell_balance.currency != "USD":
+            sell_balance.add_sell_trade(trade, basis)
+        if buy_balance.currency != "USD":
+            buy_balance.add_buy_trade(trade, basis)
+
+    def perform_spend(self, trade, comment=""):
+        balance = self.get_balance(trade.exchange, trade.sell_currency)
+        basis = self.determine_basis(trade)
+        balance.add_spend_trade(trade, basis, comment)
+
+    def perform_income(self, trade):
+        balance = self.get_balance(trade.exchange, trade.buy_currency)
+        basis = self.determine_basis(trade)
+        balance.add_income_trade(trade, basis)
+
+    def process_trades(self, trade_objs, until=None, transfers=None):
+        """
+        Processes trades sorted by time. Can be called repeatedly with later trades;
+        an unpaired withdrawal or deposit is carried over to the next call.
+        :param until: Stop at the first trade at or after this time.
+        :type until: datetime
+        :param transfers: Withdrawal/deposit pairs from `transfers.link_transfers`. A transfer is performed
+                          when its first leg is reached. Without links, a withdrawal and a deposit have to
+                          follow each other directly in the trade stream.
+        :type transfers: TransferLinks
+        """
+        withdrawal, deposit = self.pending_transfer
+
+        for trade in trade_objs:
+            if until is not None and trade.time >= until:
+                break
+
+            if is_cancelled(trade):
+                continue
+
+            if transfers is not None and (trade.type == 'Withdrawal' or trade.type == 'Deposit'):
+                if not transfers.is_linked(trade):
+                    self.diagnostics.report(
+                        MISMATCHED_TRANSFER, "unpaired withdrawal/deposit",
+                        context=lambda t=trade: f"movement: {t}",
+                        trade_id=trade.trade_id, time=trade.time.isoformat(),
+                        currency=trade.sell_currency or trade.buy_currency)
+                    continue
+                pair = transfers.complete(trade)
+                if pair is not None:
+                    transfer_withdrawal, transfer_deposit, approximate = pair
+                    if approximate:
+                        self.report_approximate_transfer(transfer_withdrawal, transfer_deposit)
+                    self.perform_transfer(transfer_withdrawal, transfer_deposit)
+            elif trade.type == 'Withdrawal' or trade.type == 'Deposit':
+                if trade.type == 'Withdrawal':
+                    withdrawal = trade
+                else:
+                    deposit = trade
+
+                if withdrawal != None and deposit != None:
+                    self.perform_transfer(withdrawal, deposit)
+                    withdrawal = None
+                    deposit = None
+            else:
+                if withdrawal != None or deposit != None:
+                    unpaired = withdrawal if withdrawal != None else deposit
+                    self.diagnostics.report(
+                        MISMATCHED_TRANSFER, "mismatched withdrawal/deposit",
+                        context=lambda w=withdrawal, d=deposit, t=trade: f"withdrawal: {w}\ndeposit: {d}\nnext trade: {t}",
+                        trade_id=unpaired.trade_id, time=unpaired.time.isoformat(),
+                        currency=unpaired.sell_currency or unpaired.buy_currency)
+
+                if trade.type == "Trade":
+                    if trade.buy_amount != 0 and trade.sell_amount != 0 and (trade.buy_value_usd != 0 or trade.sell_value_usd != 0):
+                        self.perform_trade(trade)
+                    elif trade.buy_amount != 0 and trade.sell_amount != 0 and self.price_store is not None:
+                        # No usd value at all: value it from local prices instead of skipping it.
+                        self.perform_trade(trade, required=False)
+                    else:
+                        # print(f"skipping negligible  trade: {trade}")
+                        # print("--------------------------------")
+                        pass
+                elif trade.type == "Spend":
+                    self.perform_spend(trade)
+                elif trade.type == "Donation":
+                    self.perform_spend(trade, "Donation")
+                elif trade.type == "Gift":
+                    self.perform_spend(trade, "Gift")
+                elif trade.type == "Stolen":
+                    self.perform_spend(trade, "Stolen")
+                elif trade.type == "Income":
+                    self.perform_income(trade)
+                else:
+                    self.diagnostics.report(UNACCOUNTED_TRADE_TYPE, "unaccounted for trade",
+                                            context=lambda t=trade: f"trade: {t}",
+                                            type=trade.type, trade_id=trade.trade_id, time=trade.time.isoformat())
+
+        self.pending_transfer = (withdrawal, deposit)
+
+
+# Group-by levels of the rollups and the dimensions they group by.
+ROLLUP_LEVELS = OrderedDict([
+    ('year', ('tax_year',)),
+    ('year_term', ('tax_year', 'term')),
+    ('year_currency', ('tax_year', 'currency')),
+    ('year_currency_term', ('tax_year', 'currency', 'term')),
+    ('year_exchange', ('tax_year', 'exchange')),
+])
+ROLLUP_DIMENSIONS = ['tax_year', 'term', 'currency', 'exchange']
+ROLLUP_FIELDS = ['proceeds', 'basis', 'gain', 'count']
+GAINS_FIELDS = ['proceeds', 'basis', 'gain', 'short_term_gain', 'long_term_gain', 'count']
+
+
+class Rollups(object):
+    """
+    Running totals of proceeds, basis, gain and count of realized transactions. Only the totals per
+    (tax year, term, currency, exchange) are kept up to date, the levels of `ROLLUP_LEVELS` are summed
+    up from them when needed. The exchange is the one the lot was sold on.
+    """
+
+    def __init__(self):
+        self.totals = {}
+
+    def add(self, tax_year, term, currency, exchange, proceeds, basis, count=1):
+        """
+        :param term: `short` or `long`
+        :type term: str
+        """
+        key = (tax_year, term, currency, exchange)
+        values = self.totals.get(key)
+        if values is None:
+            self.totals[key] = [proceeds, basis, proceeds - basis, count]
         else:
-            deposit = trade
+            values[0] += proceeds
+            values[1] += basis
+            values[2] += proceeds - basis
+            values[3] += count
+
+    def add_transaction(self, transaction):
+        sell_time = transaction.sell_trade.time
+        self.add(sell_time.year, 'long' if is_long_term(transaction.buy_trade.time, sell_time) else 'short',
+                 transaction.buy_trade.buy_currency, transaction.sell_trade.exchange, transaction.sell_basis,
+                 transaction.buy_basis)
+
+    def add_row(self, row):
+        """
+        Adds a transaction row as written to the report, see `Transaction.to_odict`.
+        """
+        self.add(int(row['tax_year']), 'long' if row['is_long'] == 'True' else 'short', row['currency'],
+                 row['sell_exchange'], Decimal(row['proceeds']), Decimal(row['basis']))
 
-        if withdrawal != None and deposit != None:
-            perform_transfer(withdrawal, deposit)
-            withdrawal = None
-            deposit = None
-    else:
-        if withdrawal != None or deposit != None:
-            print("mismatched withdrawal/deposit")
-            print(f"withdrawal: {withdrawal}")
-            print(f"desposit: {deposit}")
-            print(f"next trade: {trade}")
-            print("--------------------------------")
-
-        if trade.type == "Trade":
-            if trade.buy_amount != 0 and trade.sell_amount != 0 and (trade.buy_value_usd != 0 or trade.sell_value_usd != 0):
-                perform_trade(trade)
+    def years(self):
+        return sorted(set(key[0] for key in self.totals))
+
+    def level(self, level):
+        """
+        :param level: one of `ROLLUP_LEVELS`
+        :type level: str
+        :return: totals [proceeds, basis, gain, count] per key of the level's dimensions
+        :rtype: dict
+        """
+        indices = [ROLLUP_DIMENSIONS.index(dimension) for dimension in ROLLUP_LEVELS[level]]
+        totals = {}
+        for key in sorted(self.totals):
+            level_key = tuple(key[i] for i in indices)
+            values = totals.get(level_key)
+            if values is None:
+                totals[level_key] = list(self.totals[key])
             else:
-                # print(f"skipping negligible  trade: {trade}")
-                # print("--------------------------------")
-                pass
-        elif trade.type == "Spend":
-            perform_spend(trade)
-        elif trade.type == "Donation":
-            perform_spend(trade, "Donation")
-        elif trade.type == "Gift":
-            perform_spend(trade, "Gift")
-        elif trade.type == "Stolen":
-            perform_spend(trade, "Stolen")
-        elif trade.type == "Income":
-            perform_income(trade)
-        else:
-            print(f"unaccounted for trade: {trade}")
-            print("--------------------------------")
+                for i, value in enumerate(self.totals[key]):
+                    values[i] += value
+        return totals
 
-transactions = [x.to_odict() for x in transactions]
+    def gains(self):
+        """
+        Sums up the `year_currency_term` level per (tax_year, currency), with the gain split by term.
+        Currency "ALL" holds the tax year total.
+        :return: (tax_year, currency) -> values of `GAINS_FIELDS`
+        :rtype: dict
+        """
+        gains = {}
+        for (tax_year, currency, term), (proceeds, basis, gain, count) in self.level('year_currency_term').items():
+            for key in ((tax_year, currency), (tax_year, "ALL")):
+                totals = gains.get(key)
+                if totals is None:
+                    totals = gains[key] = [Decimal(0)] * 5 + [0]
+                totals[0] += proceeds
+                totals[1] += basis
+                totals[2] += gain
+                totals[3 if term == 'short' else 4] += gain
+                totals[5] += count
+        return gains
+
+    def rows(self):
+        """
+        Yields one row per level and group, dimensions a level does not group by are empty.
+        :rtype: generator
+        """
+        for level, dimensions in ROLLUP_LEVELS.items():
+            totals = self.level(level)
+            for key in sorted(totals):
+                row = OrderedDict([('level', level)])
+                row.update((dimension, '') for dimension in ROLLUP_DIMENSIONS)
+                row.update(zip(dimensions, key))
+                row.update(zip(ROLLUP_FIELDS, ['{0:f}'.format(value) for value in totals[key][:3]] + [totals[key][3]]))
+                yield row
+
+    def differences(self, other):
+        """
+        Compares two rollups at every level.
+        :return: (level, key, field, value, other value) for every value that differs
+        :rtype: list<tuple>
+        """
+        output = []
+        for level in ROLLUP_LEVELS:
+            totals, other_totals = self.level(level), other.level(level)
+            for key in sorted(set(totals) | set(other_totals)):
+                values = totals.get(key, [Decimal(0)] * 3 + [0])
+                other_values = other_totals.get(key, [Decimal(0)] * 3 + [0])
+                for field, value, other_value in zip(ROLLUP_FIELDS, values, other_values):
+                    if value != other_value:
+                        output.append((level, key, field, value, other_value))
+        return output
+
+
+def write_rollups(filename, rollups):
+    with open_file(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['level'] + ROLLUP_DIMENSIONS + ROLLUP_FIELDS)
+        writer.writeheader()
+        for row in rollups.rows():
+            writer.writerow(row)
+
+
+def check_rollups(rollups, report_filenames):
+    """
+    Recomputes the rollups from the detail report and compares them to the ones the engine kept.
+    :param report_filenames: the report, or all its partitions
+    :type report_filenames: list<str>
+    :return: differences, see `Rollups.differences`
+    :rtype: list<tuple>
+    """
+    recomputed = Rollups()
+    for filename in report_filenames:
+        with open_file(filename, newline='') as f:
+            for row in csv.DictReader(f):
+                recomputed.add_row(row)
+    return rollups.differences(recomputed)
+
+
+def _drain(trade_objs):
+    """
+    Yields trades while dropping the list's references to them, so processed trades can be freed.
+    """
+    for i in range(0, len(trade_objs)):
+        trade = trade_objs[i]
+        trade_objs[i] = None
+        yield trade
+
+
+def find_transfers(trade_objs, transfer_window=DEFAULT_WINDOW):
+    """
+    Links the withdrawals and deposits of trades for `Ledger.process_trades`, ignoring cancelled ones.
+    :param transfer_window: Maximum time in seconds between a withdrawal and its deposit, see `transfers.py`.
+    :type transfer_window: int
+    :return: the links, or None to only pair withdrawals and deposits that directly follow each other
+             if `transfer_window` is None
+    :rtype: TransferLinks|None
+    """
+    if transfer_window is None:
+        return None
+    return link_transfers((trade for trade in trade_objs if not is_cancelled(trade)), transfer_window)
+
+
+def generate_report(input_filename, output_filename, open_lots_filename=None, method='FIFO', spool=False,
+                    diagnostics=None, price_store=None, json_format=None, tax_year=None, partition=False,
+                    transfer_window=DEFAULT_WINDOW):
+    """
+    Reads trades, runs them through a fresh ledger and writes the transaction report.
+    :param input_filename: json or csv file with trades
+    :type input_filename: str
+    :param output_filename: csv file for the transactions
+    :type output_filename: str
+    :param open_lots_filename: Optional json file for the remaining open lots.
+    :type open_lots_filename: str
+    :param method: Cost basis method, one of FIFO, LIFO, HIFO.
+    :type method: str
+    :param spool: Write transactions to the output as they are realized instead of keeping them in memory.
+                  Memory then only grows with the open lots. `ledger.transactions` stays empty.
+    :type spool: bool
+    :param diagnostics: Collector for data problems. A default one is created if not given.
+    :type diagnostics: Diagnostics
+    :param price_store: Local prices used to value trades that have no usd value. Every basis filled in
+                        from it is written to `fills_filename(output_filename)`.
+    :type price_store: PriceStore
+    :param json_format: Format of the open lots file, see `tools.write_json`.
+    :type json_format: str
+    :param tax_year: Only report this tax year. Earlier trades just build up the lots and processing
+                     stops at the end of the year, so open lots are as of the end of that year.
+    :type tax_year: int
+    :param partition: Write one file per tax year, see `partition_filename`.
+    :type partition: bool
+    :param transfer_window: Maximum time in seconds between a withdrawal and its deposit, see `transfers.py`.
+                            None pairs only withdrawals and deposits that directly follow each other.
+    :type transfer_window: int
+    :return: the ledger after processing
+    :rtype: Ledger
+    """
+    trade_objs = sorted(convert_trade_objs(read_trades_from_file(input_filename)))
+    transfers = find_transfers(trade_objs, transfer_window)
+
+    record_from = until = None
+    if tax_year is not None:
+        record_from = datetime(tax_year, 1, 1)
+        until = datetime(tax_year + 1, 1, 1)
+
+    fill_log = FillLog(fills_filename(output_filename)) if price_store is not None else None
+    try:
+        if spool:
+            with TransactionSpool(output_filename, partition) as transaction_spool:
+                ledger = Ledger(method, transaction_spool, diagnostics, price_store, record_from=record_from,
+                                fill_log=fill_log)
+                ledger.process_trades(_drain(trade_objs), until, transfers)
+        else:
+            ledger = Ledger(method, diagnostics=diagnostics, price_store=price_store, record_from=record_from,
+                            fill_log=fill_log)
+            ledger.process_trades(trade_objs, until, transfers)
+            with TransactionSpool(output_filename, partition) as transaction_spool:
+                for transaction in ledger.transactions:
+                    transaction_spool.append(transaction)
+    finally:
+        if fill_log is not None:
+            fill_log.close()
+
+    write_rollups(rollups_filename(output_filename), ledger.rollups)
+
+    if open_lots_filename is not None:
+        write_json(ledger.open_lots().to_list(), open_lots_filename, json_format)
+
+    return ledger
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates a csv report of realized gains from trades.")
+    parser.add_argument('input', metavar='json_or_csv_file')
+    parser.add_argument('output', metavar='output_csv')
+    parser.add_argument('open_lots', metavar='open_lots_json', nargs='?', help="also write the remaining open lots")
+    parser.add_argument('--method', choices=METHODS, default='FIFO', help="cost basis method (default: FIFO)")
+    parser.add_argument('--spool', action='store_true',
+                        help="write transactions as they are realized instead of keeping them in memory")
+    parser.add_argument('--samples', type=int, default=5, help="number of problems printed per category (default: 5)")
+    parser.add_argument('--events', metavar='events_jsonl', help="write every problem found as a json line")
+    parser.add_argument('--event-context', action='store_true',
+                        help="include context, e.g. recent balance transactions, in the events file")
+    parser.add_argument('--year', type=int, help="only report this tax year and stop processing at its end")
+    parser.add_argument('--partition', action='store_true',
+                        help="write one file per tax year, e.g. tax_report.2017.csv for tax_report.csv")
+    parser.add_argument('--compact', action='store_true', help="write the open lots json without indentation")
+    parser.add_argument('--prices', metavar='price_index',
+                        help="price index (see price_index.py) used to fill in trades without usd value")
+    parser.add_argument('--transfer-window', type=float, default=DEFAULT_WINDOW / 3600, metavar='HOURS',
+                        help="maximum time between a withdrawal and its deposit (default: 24)")
+    parser.add_argument('--adjacent-transfers', action='store_true',
+                        help="only pair a withdrawal and a deposit that directly follow each other")
+    parser.add_argument('--check-rollups', action='store_true',
+                        help="recompute the rollups from the written report and compare")
+    parser.add_argument('--progress', action='store_true', help="print read and conversion throughput to stderr")
+    parser.add_argument('--metrics', metavar='metrics_json', help="write read and conversion metrics as json")
+    args = parser.parse_args()
+
+    telemetry.setup(args.progress, args.metrics)
+    transfer_window = None if args.adjacent_transfers else int(args.transfer_window * 3600)
+    price_store = PriceStore.open(args.prices) if args.prices else None
+    events_file = open_file(args.events, 'w') if args.events else None
+    diagnostics = Diagnostics(args.samples, events_file, args.event_context)
+    try:
+        ledger = generate_report(args.input, args.output, args.open_lots, args.method, args.spool, diagnostics,
+                                 price_store, 'compact' if args.compact else None, args.year, args.partition,
+                                 transfer_window)
+    finally:
+        diagnostics.print_summary()
+        if events_file is not None:
+            events_file.close()
+
+    if args.open_lots is not None:
+        print(f"Exported {len(ledger.open_lots().positions())} open positions.")
+
+    if args.check_rollups:
+        report_filenames = [partition_filename(args.output, year) for year in ledger.rollups.years()] \
+            if args.partition else [args.output]
+        differences = check_rollups(ledger.rollups, report_filenames)
+        for level, key, field, value, report_value in differences:
+            print(f"Rollup mismatch: {level} {key} {field}: {value} (report: {report_value})")
+        if differences:
+            exit(1)
+        print("Rollups match the report.")
 
-with open(sys.argv[2], 'w') as output_file:
-    json.dump(transactions, output_file, indent=4)
+    print(f"Success. Exported {ledger.transaction_count} items.")
 
-with open(sys.argv[2], 'w', newline='') as f:
-    writer = csv.DictWriter(f, fieldnames=Transaction.fieldnames)
-    writer.writeheader()
-    for transaction in transactions:
-        writer.writerow(transaction)
 
-print(f"Success. Exported {len(transactions)} items.")
+if __name__ == '__main__':
+    main()
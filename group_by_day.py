@@ -25,6 +25,8 @@ import sys
 
 from decimal import Decimal
 
+from tools import open_file
+
 
 class Record(object):
 
@@ -71,7 +73,7 @@ output = []
 previous = None
 header = None
 
-with open(sys.argv[1]) as csvfile:
+with open_file(sys.argv[1]) as csvfile:
     csvdata = csv.reader(csvfile, delimiter=',', )
 
     for row in csvdata:
@@ -99,7 +101,7 @@ with open(sys.argv[1]) as csvfile:
     output.append(previous)
 
 if output:
-    with open(sys.argv[2], 'w') as csvfile:
+    with open_file(sys.argv[2], 'w') as csvfile:
         print(header)
         csvfile.writelines(','.join(header) + '\n')
         for record in output:
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Queryable open-lot state left over after running the tax engine.
+
+`OpenLots` holds the remaining lots (amount and basis) per (exchange, currency) and can
+simulate disposals under FIFO, LIFO or HIFO without touching the underlying state.
+Lots are kept in immutable tuples, so a simulated sale that is applied with `after_sale`
+only rebuilds the affected (exchange, currency) entry and shares everything else.
+"""
+from collections import OrderedDict, namedtuple
+from decimal import Decimal
+from dateutil.relativedelta import relativedelta
+
+
+METHODS = ('FIFO', 'LIFO', 'HIFO')
+
+LONG_TERM = relativedelta(days=365)  # relativedelta(years=1)
+
+
+def is_long_term(buy_time, sell_time):
+    """
+    Returns True if a lot bought at `buy_time` and sold at `sell_time` counts as long term.
+    """
+    return sell_time >= buy_time + LONG_TERM
+
+
+class Lot(namedtuple('Lot', ['exchange', 'currency', 'amount', 'basis', 'buy_time'])):
+    """
+    A single open lot.
+    """
+    __slots__ = ()
+
+    @property
+    def unit_basis(self):
+        return self.basis / self.amount if self.amount else Decimal(0)
+
+    def to_odict(self):
+        return OrderedDict([
+            ('exchange', self.exchange),
+            ('currency', self.currency),
+            ('amount', '{0:f}'.format(self.amount)),
+            ('basis', '{0:f}'.format(self.basis)),
+            ('buy_time', self.buy_time.isoformat()),
+        ])
+
+
+class Position(namedtuple('Position', ['exchange', 'currency', 'amount', 'basis', 'first_buy_time',
+                                       'last_buy_time', 'average_buy_time', 'num_lots'])):
+    """
+    Aggregated view over all open lots of one (exchange, currency).
+    `average_buy_time` is weighted by amount.
+    """
+    __slots__ = ()
+
+    def holding_period(self, as_of):
+        """
+        Returns the amount-weighted holding period as of `as_of`.
+        :rtype: timedelta
+        """
+        return as_of - self.average_buy_time
+
+    def to_odict(self):
+        return OrderedDict([
+            ('exchange', self.exchange),
+            ('currency', self.currency),
+            ('amount', '{0:f}'.format(self.amount)),
+            ('basis', '{0:f}'.format(self.basis)),
+            ('first_buy_time', self.first_buy_time.isoformat()),
+            ('last_buy_time', self.last_buy_time.isoformat()),
+            ('average_buy_time', self.average_buy_time.isoformat()),
+            ('num_lots', self.num_lots),
+        ])
+
+
+SaleSimulation = namedtuple('SaleSimulation', [
+    'amount', 'proceeds', 'basis', 'gain',
+    'short_term_amount', 'short_term_gain', 'long_term_amount', 'long_term_gain',
+    'unmatched_amount',
+])
+
+
+class OpenLots(object):
+    """
+    Open lots per (exchange, currency). Never mutated after construction.
+    """
+
+    def __init__(self, lots_by_key):
+        """
+        :param lots_by_key: (exchange, currency) -> lots, in the order the engine would consume them (FIFO)
+        :type lots_by_key: dict
+        """
+        self._lots = {key: tuple(lots) for key, lots in lots_by_key.items() if lots}
+        self._ordered = {}
+        self._positions = None
+
+    @classmethod
+    def from_balances(cls, balances):
+        """
+        Builds open lots from the tax engine's balances.
+        :param balances: (exchange, currency) -> Balance
+        :type balances: dict
+        :rtype: OpenLots
+        """
+        lots_by_key = {}
+        for (exchange, currency), balance in balances.items():
+            if currency == "USD" or currency == "":
+                continue
+            lots_by_key[(exchange, currency)] = [
+                Lot(exchange, currency, entry.amount_remaining, entry.basis, entry.buy_trade.time)
+                for entry in balance.entries() if entry.amount_remaining > 0
+            ]
+        return cls(lots_by_key)
+
+    def keys(self):
+        return sorted(self._lots.keys())
+
+    def lots(self, exchange, currency):
+        """
+        Returns the open lots of an (exchange, currency) in FIFO order.
+        :rtype: tuple<Lot>
+        """
+        return self._lots.get((exchange, currency), ())
+
+    def position(self, exchange, currency):
+        """
+        :rtype: Position|None
+        """
+        return self.positions().get((exchange, currency))
+
+    def positions(self):
+        """
+        Returns aggregated amount, basis and holding period per (exchange, currency).
+        :rtype: dict
+        """
+        if self._positions is None:
+            self._positions = OrderedDict()
+            for key in self.keys():
+                self._positions[key] = self._aggregate(key, self._lots[key])
+        return self._positions
+
+    @staticmethod
+    def _aggregate(key, lots):
+        amount = sum((lot.amount for lot in lots), Decimal(0))
+        basis = sum((lot.basis for lot in lots), Decimal(0))
+        first = min(lot.buy_time for lot in lots)
+        last = max(lot.buy_time for lot in lots)
+        # Weighted by amount, relative to the first buy to keep the numbers small.
+        weighted = sum((lot.amount * Decimal((lot.buy_time - first).total_seconds()) for lot in lots), Decimal(0))
+        offset = (weighted / amount) if amount else Decimal(0)
+        average = first + relativedelta(seconds=int(offset))
+        return Position(key[0], key[1], amount, basis, first, last, average, len(lots))
+
+    def _ordered_lots(self, key, method):
+        """
+        Returns the lots of `key` in consumption order for `method`. Cached per (key, method).
+        """
+        if method not in METHODS:
+            raise ValueError(f"Unknown cost basis method: {method}")
+        cache_key = (key, method)
+        ordered = self._ordered.get(cache_key)
+        if ordered is None:
+            lots = self._lots.get(key, ())
+            if method == 'FIFO':
+                ordered = lots
+            elif method == 'LIFO':
+                ordered = tuple(reversed(lots))
+            else:
+                ordered = tuple(sorted(lots, key=lambda lot: lot.unit_basis, reverse=True))
+            self._ordered[cache_key] = ordered
+        return ordered
+
+    def simulate_sale(self, exchange, currency, amount, proceeds, time, method='FIFO'):
+        """
+        Simulates selling `amount` units for `proceeds` USD at `time` without changing any state.
+        :param amount: Units to sell.
+        :type amount: Decimal
+        :param proceeds: Total USD proceeds of the sale.
+        :type proceeds: Decimal
+        :param time: Time of the sale, used for the short/long term split.
+        :type time: datetime
+        :param method: One of FIFO, LIFO, HIFO.
+        :type method: str
+        :rtype: SaleSimulation
+        """
+        simulation, _, _ = self._sell((exchange, currency), Decimal(amount), Decimal(proceeds), time, method)
+        return simulation
+
+    def after_sale(self, exchange, currency, amount, proceeds, time, method='FIFO'):
+        """
+        Like `simulate_sale`, but also returns the lot state after the sale.
+        The returned state shares all untouched lots with this one.
+        :rtype: (SaleSimulation, OpenLots)
+        """
+        key = (exchange, currency)
+        simulation, consumed, partial = self._sell(key, Decimal(amount), Decimal(proceeds), time, method)
+        consumed_ids = set(map(id, consumed))
+        partial_id = id(self._ordered_lots(key, method)[len(consumed)]) if partial is not None else None
+        remaining = []
+        for lot in self._lots.get(key, ()):
+            if id(lot) in consumed_ids:
+                continue
+            remaining.append(partial if id(lot) == partial_id else lot)
+        lots_by_key = dict(self._lots)
+        lots_by_key[key] = remaining
+        return simulation, OpenLots(lots_by_key)
+
+    def _sell(self, key, amount, proceeds, time, method):
+        ordered = self._ordered_lots(key, method)
+        amount_remaining = amount
+        proceeds_remaining = proceeds
+        basis_total = Decimal(0)
+        short_amount = long_amount = Decimal(0)
+        short_gain = long_gain = Decimal(0)
+        consumed = 0
+        partial = None
+
+        for lot in ordered:
+            if amount_remaining <= 0:
+                break
+            sell_amount = min(amount_remaining, lot.amount)
+            sell_proceeds = sell_amount * proceeds_remaining / amount_remaining
+            sell_basis = sell_amount * lot.basis / lot.amount
+            gain = sell_proceeds - sell_basis
+            if is_long_term(lot.buy_time, time):
+                long_amount += sell_amount
+                long_gain += gain
+            else:
+                short_amount += sell_amount
+                short_gain += gain
+            basis_total += sell_basis
+            amount_remaining -= sell_amount
+            proceeds_remaining -= sell_proceeds
+            if sell_amount < lot.amount:
+                partial = lot._replace(amount=lot.amount - sell_amount, basis=lot.basis - sell_basis)
+            else:
+                consumed += 1
+
+        simulation = SaleSimulation(
+            amount=amount - amount_remaining,
+            proceeds=proceeds - proceeds_remaining,
+            basis=basis_total,
+            gain=short_gain + long_gain,
+            short_term_amount=short_amount,
+            short_term_gain=short_gain,
+            long_term_amount=long_amount,
+            long_term_gain=long_gain,
+            unmatched_amount=amount_remaining,
+        )
+        return simulation, ordered[:consumed], partial
+
+    def to_list(self):
+        """
+        Returns positions with their lots, ready to be dumped as json.
+        :rtype: list
+        """
+        output = []
+        for key, position in self.positions().items():
+            item = position.to_odict()
+            item['lots'] = [lot.to_odict() for lot in self._lots[key]]
+            output.append(item)
+        return output
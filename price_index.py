@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Local historical USD price index.
+
+Prices are bulk-loaded once from csv price dumps or saved `getHistoricalCurrency` API responses
+into sorted per-currency arrays and saved to a binary index file. Lookups memory-map that file
+and binary search it, so the tax engine can fill in a missing USD value without any network access.
+
+Csv price dumps need the columns `currency`, `time` and `price` (USD per unit). `time` is a unix
+timestamp, `YYYY-MM-DD` or `YYYY-MM-DDTHH:MM:SS`.
+Api responses are json files as returned by `api.get_historical_currency()`; the price is taken
+as fiat value divided by amount.
+
+Prices are stored as 64 bit floats, not as exact decimals. A price with up to 15 significant digits
+comes back unchanged: quotes are turned into a `Decimal` through the float's shortest repr, so an
+exact match for 1234.56 is Decimal('1234.56'). Interpolated prices and prices derived from api
+responses are computed in float and are only accurate to about 15 significant digits.
+
+Usage:
+
+    python price_index.py build data/prices.idx data/prices.csv data/historical_eth.json
+    python price_index.py lookup data/prices.idx ETH 2017-04-04T15:39:05
+"""
+import argparse
+import bisect
+import calendar
+import csv
+import mmap
+import struct
+from array import array
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal
+
+import codec
+from tools import open_file, split_compression
+
+
+MAGIC = b'CTPRICE1'
+
+# Keys of a `getHistoricalCurrency` entry that may hold the fiat value.
+FIAT_VALUE_KEYS = ('value_fiat', 'fiat_value', 'fiat', 'value')
+
+PriceQuote = namedtuple('PriceQuote', ['currency', 'time', 'price', 'method', 'source_times'])
+
+
+def to_timestamp(value):
+    """
+    Converts a datetime (naive, UTC) or a timestamp / date string to a unix timestamp.
+    :rtype: int
+    """
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple())
+    value = str(value).strip()
+    if value.isdigit():
+        return int(value)
+    for fmt in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%d.%m.%Y %H:%M", "%d.%m.%Y"):
+        try:
+            return calendar.timegm(datetime.strptime(value, fmt).utctimetuple())
+        except ValueError:
+            pass
+    raise ValueError(f"Unknown time format: {value}")
+
+
+def read_price_csv(filename):
+    """
+    Yields (currency, timestamp, price) from a csv price dump.
+    """
+    with open_file(filename, newline='') as f:
+        for row in csv.DictReader(f):
+            yield row['currency'].strip(), to_timestamp(row['time']), float(row['price'])
+
+
+def read_historical_currency(filename):
+    """
+    Yields (currency, timestamp, price) from a saved `getHistoricalCurrency` response.
+    """
+    with open_file(filename) as f:
+        response = codec.load(f)
+    for currency, entries in response.items():
+        if not isinstance(entries, dict):
+            # "success", "method" and the like
+            continue
+        for timestamp, entry in entries.items():
+            amount = float(entry.get('amount') or 0)
+            value = next((entry[key] for key in FIAT_VALUE_KEYS if key in entry), None)
+            if amount and value is not None:
+                yield currency, int(timestamp), float(value) / amount
+
+
+class PriceStore(object):
+    """
+    Sorted timestamps and prices per currency with binary search lookups.
+    """
+
+    def __init__(self, series, mapped=None):
+        """
+        :param series: currency -> (timestamps, prices), both sorted by timestamp
+        :type series: dict
+        """
+        self._series = series
+        self._mapped = mapped
+
+    @classmethod
+    def build(cls, sources):
+        """
+        Bulk-loads prices from csv dumps and saved api responses.
+        :param sources: filenames, `.csv` files are read as price dumps, anything else as api responses
+        :type sources: list<str>
+        :rtype: PriceStore
+        """
+        points = {}
+        for filename in sources:
+            reader = read_price_csv if split_compression(filename)[0].endswith(".csv") else read_historical_currency
+            for currency, timestamp, price in reader(filename):
+                # Later sources win for the same timestamp.
+                points.setdefault(currency, {})[timestamp] = price
+        series = {}
+        for currency, by_time in points.items():
+            timestamps = sorted(by_time)
+            series[currency] = (array('q', timestamps), array('d', (by_time[t] for t in timestamps)))
+        return cls(series)
+
+    def save(self, filename):
+        """
+        Writes the index file: magic, header length, json header with offsets, then the arrays.
+        """
+        header = {}
+        offset = 0
+        for currency in sorted(self._series):
+            timestamps, _ = self._series[currency]
+            header[currency] = [offset, len(timestamps)]
+            offset += len(timestamps) * 16
+        header_bytes = codec.dumps(header).encode('utf8')
+        header_bytes += b' ' * (-len(header_bytes) % 8)
+        with open(filename, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header_bytes)))
+            f.write(header_bytes)
+            for currency in sorted(self._series):
+                timestamps, prices = self._series[currency]
+                array('q', timestamps).tofile(f)
+                array('d', prices).tofile(f)
+
+    @classmethod
+    def open(cls, filename):
+        """
+        Memory-maps an index file written by `save`.
+        :rtype: PriceStore
+        """
+        with open(filename, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapped[:8] != MAGIC:
+            raise ValueError(f"Not a price index: {filename}")
+        header_length = struct.unpack('<Q', mapped[8:16])[0]
+        header = codec.loads(mapped[16:16 + header_length].decode('utf8'))
+        data = memoryview(mapped)[16 + header_length:]
+        series = {}
+        for currency, (offset, count) in header.items():
+            timestamps = data[offset:offset + count * 8].cast('q')
+            prices = data[offset + count * 8:offset + count * 16].cast('d')
+            series[currency] = (timestamps, prices)
+        return cls(series, mapped)
+
+    def currencies(self):
+        return sorted(self._series)
+
+    def __len__(self):
+        return sum(len(timestamps) for timestamps, _ in self._series.values())
+
+    def price(self, currency, time, max_gap=86400, interpolate=True):
+        """
+        Returns the USD price of a currency at a time.
+        :param currency: Currency symbol, e.g. ETH.
+        :type currency: str
+        :param time: datetime (naive, UTC) or unix timestamp
+        :param max_gap: Maximum distance in seconds to a known price.
+        :type max_gap: int
+        :param interpolate: Interpolate linearly between the surrounding prices if both are within `max_gap`.
+                            Otherwise the nearest price is used.
+        :type interpolate: bool
+        :return: the quote or None if there is no price close enough
+        :rtype: PriceQuote|None
+        """
+        series = self._series.get(currency)
+        if series is None or len(series[0]) == 0:
+            return None
+        timestamps, prices = series
+        timestamp = time if isinstance(time, int) else to_timestamp(time)
+
+        i = bisect.bisect_left(timestamps, timestamp)
+        if i < len(timestamps) and timestamps[i] == timestamp:
+            return PriceQuote(currency, timestamp, Decimal(repr(prices[i])), 'exact', (timestamp,))
+
+        before = i - 1 if i > 0 and timestamp - timestamps[i - 1] <= max_gap else None
+        after = i if i < len(timestamps) and timestamps[i] - timestamp <= max_gap else None
+
+        if before is not None and after is not None and interpolate:
+            t0, t1 = timestamps[before], timestamps[after]
+            p0, p1 = prices[before], prices[after]
+            price = p0 + (p1 - p0) * (timestamp - t0) / (t1 - t0)
+            return PriceQuote(currency, timestamp, Decimal(repr(price)), 'interpolated', (t0, t1))
+
+        candidates = [j for j in (before, after) if j is not None]
+        if not candidates:
+            return None
+        nearest = min(candidates, key=lambda j: abs(timestamps[j] - timestamp))
+        return PriceQuote(currency, timestamp, Decimal(repr(prices[nearest])), 'nearest', (timestamps[nearest],))
+
+    def value_trade(self, trade, max_gap=86400):
+        """
+        Values a trade in USD from its sell leg, or from its buy leg if the sell currency has no price.
+        :type trade: tools.Trade
+        :return: USD value, the quote used and the leg ('sell' or 'buy'), or None
+        :rtype: (Decimal, PriceQuote, str)|None
+        """
+        for leg, currency, amount in (('sell', trade.sell_currency, trade.sell_amount),
+                                      ('buy', trade.buy_currency, trade.buy_amount)):
+            if not currency or not amount:
+                continue
+            quote = self.price(currency, trade.time, max_gap)
+            if quote is not None:
+                return amount * quote.price, quote, leg
+        return None
+
+    def close(self):
+        if self._mapped is not None:
+            self._series = {}
+            self._mapped.close()
+            self._mapped = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds and queries a local historical price index.")
+    commands = parser.add_subparsers(dest='command')
+    # add_subparsers(required=True) needs Python 3.7.
+    commands.required = True
+    build = commands.add_parser('build', help="bulk-load price dumps into an index file")
+    build.add_argument('index_file')
+    build.add_argument('sources', nargs='+', metavar='csv_or_json_file')
+    lookup = commands.add_parser('lookup', help="look up a price")
+    lookup.add_argument('index_file')
+    lookup.add_argument('currency')
+    lookup.add_argument('time')
+    lookup.add_argument('--max-gap-hours', type=float, default=24)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        store = PriceStore.build(args.sources)
+        store.save(args.index_file)
+        print(f"Success. Indexed {len(store)} prices for {len(store.currencies())} currencies.")
+    else:
+        store = PriceStore.open(args.index_file)
+        quote = store.price(args.currency, to_timestamp(args.time), int(args.max_gap_hours * 3600))
+        if quote is None:
+            print(f"No price for {args.currency} within {args.max_gap_hours} hours of {args.time}.")
+            exit(1)
+        print(f"{quote.price} ({quote.method})")
+
+
+if __name__ == '__main__':
+    main()
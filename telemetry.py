@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Progress and throughput telemetry for long running reads, conversions and API calls.
+
+Instrumented code reports to the sinks registered with `add_sink`. A sink is any callable taking
+an event name and a metrics dict:
+
+ - `progress`: periodically while a stage runs (at most every `PROGRESS_INTERVAL` seconds)
+ - `finish`: once when a stage is done
+ - `request`: after every API request
+
+Stage metrics are `stage`, `rows`, `bytes`, `elapsed`, `rows_per_sec`, `bytes_per_sec`,
+`total_rows`, `total_bytes` and `eta` (seconds, None if unknown). Request metrics are `method`,
+`latency`, `throttle_wait`, `status` and `bytes`.
+
+Without sinks, `track` returns the iterable unchanged and nothing is measured.
+
+    telemetry.add_sink(telemetry.StderrProgress())
+    telemetry.add_sink(lambda event, metrics: print(event, metrics))
+"""
+import atexit
+import sys
+import time
+from collections import OrderedDict
+
+import codec
+
+
+# Minimum seconds between two progress events of a stage.
+PROGRESS_INTERVAL = 0.5
+
+# Rows between two looks at the clock.
+CHECK_EVERY = 256
+
+_sinks = []
+
+
+def add_sink(sink):
+    """
+    Registers a sink.
+    :param sink: called with the event name and a metrics dict
+    :type sink: callable
+    """
+    _sinks.append(sink)
+
+
+def remove_sink(sink):
+    _sinks.remove(sink)
+
+
+def enabled():
+    return bool(_sinks)
+
+
+def emit(event, metrics):
+    for sink in _sinks:
+        sink(event, metrics)
+
+
+def close():
+    """
+    Closes and removes all sinks. Sinks that write files write them now.
+    """
+    while _sinks:
+        sink = _sinks.pop()
+        if hasattr(sink, 'close'):
+            sink.close()
+
+
+class Progress(object):
+    """
+    Measures one stage, e.g. reading a file.
+    """
+
+    def __init__(self, stage, total_rows=None, total_bytes=None, position=None):
+        """
+        :param stage: Name of the stage.
+        :type stage: str
+        :param total_rows: Number of rows expected, if known.
+        :type total_rows: int
+        :param total_bytes: Number of bytes expected, if known.
+        :type total_bytes: int
+        :param position: Returns the number of bytes processed so far, or None if it can't tell.
+                         Only called when an event is emitted.
+        :type position: callable
+        """
+        self.stage = stage
+        self.total_rows = total_rows
+        self.total_bytes = total_bytes
+        self.position = position
+        self.rows = 0
+        self.start = time.perf_counter()
+        self._next_check = CHECK_EVERY
+        self._next_emit = self.start + PROGRESS_INTERVAL
+
+    def update(self, rows=1):
+        self.rows += rows
+        if self.rows >= self._next_check:
+            self._next_check = self.rows + CHECK_EVERY
+            now = time.perf_counter()
+            if now >= self._next_emit:
+                self._next_emit = now + PROGRESS_INTERVAL
+                emit('progress', self.metrics(now))
+
+    def finish(self, num_bytes=None):
+        """
+        :param num_bytes: Bytes processed, if `position` can't tell.
+        :type num_bytes: int
+        """
+        emit('finish', self.metrics(time.perf_counter(), num_bytes))
+
+    def metrics(self, now, num_bytes=None):
+        elapsed = now - self.start
+        if num_bytes is None and self.position is not None:
+            num_bytes = self.position()
+        eta = None
+        if self.total_rows and self.rows:
+            eta = elapsed * (self.total_rows - self.rows) / self.rows
+        elif self.total_bytes and num_bytes:
+            eta = elapsed * (self.total_bytes - num_bytes) / num_bytes
+        return OrderedDict([
+            ('stage', self.stage),
+            ('rows', self.rows),
+            ('bytes', num_bytes),
+            ('elapsed', elapsed),
+            ('rows_per_sec', self.rows / elapsed if elapsed else None),
+            ('bytes_per_sec', num_bytes / elapsed if elapsed and num_bytes is not None else None),
+            ('total_rows', self.total_rows),
+            ('total_bytes', self.total_bytes),
+            ('eta', max(eta, 0.0) if eta is not None else None),
+        ])
+
+
+def _tracked(progress, iterable):
+    for item in iterable:
+        yield item
+        progress.update()
+    progress.finish()
+
+
+def track(stage, iterable, total_rows=None, total_bytes=None, position=None):
+    """
+    Counts the items of an iterable as rows of a stage. See `Progress` for the parameters.
+    :return: the iterable itself if no sink is registered
+    """
+    if not _sinks:
+        return iterable
+    if total_rows is None and hasattr(iterable, '__len__'):
+        total_rows = len(iterable)
+    return _tracked(Progress(stage, total_rows, total_bytes, position), iterable)
+
+
+def request(method, latency, throttle_wait=0.0, status=None, num_bytes=None):
+    """
+    Reports an API request.
+    :param latency: Seconds from sending the request to having the response.
+    :type latency: float
+    :param throttle_wait: Seconds waited before sending because of the rate limit.
+    :type throttle_wait: float
+    """
+    if _sinks:
+        emit('request', OrderedDict([('method', method), ('latency', latency), ('throttle_wait', throttle_wait),
+                                     ('status', status), ('bytes', num_bytes)]))
+
+
+def _format_duration(seconds):
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+class StderrProgress(object):
+    """
+    Prints a single, continuously overwritten progress line per stage to stderr.
+    """
+
+    def __init__(self, file=None):
+        self.file = file if file is not None else sys.stderr
+
+    def __call__(self, event, metrics):
+        if event == 'request':
+            line = f"api {metrics['method']}: {metrics['latency']:.2f}s"
+            if metrics['throttle_wait']:
+                line += f" (waited {metrics['throttle_wait']:.2f}s)"
+            self.file.write(f"\r{line}\n")
+        else:
+            line = f"{metrics['stage']}: {metrics['rows']} rows"
+            if metrics['rows_per_sec'] is not None:
+                line += f", {metrics['rows_per_sec']:.0f} rows/s"
+            if metrics['bytes_per_sec'] is not None:
+                line += f", {metrics['bytes_per_sec'] / 1e6:.1f} MB/s"
+            if event == 'progress':
+                line += f", eta {_format_duration(metrics['eta'])}"
+            else:
+                line += f", done in {metrics['elapsed']:.2f}s"
+            self.file.write(f"\r{line}" + ("\n" if event == 'finish' else ""))
+        self.file.flush()
+
+
+class MetricsFile(object):
+    """
+    Collects the final metrics of every stage and totals of the API requests, and writes them as json on `close`.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.stages = []
+        self.requests = OrderedDict([('count', 0), ('latency', 0.0), ('max_latency', 0.0), ('throttle_wait', 0.0),
+                                     ('bytes', 0)])
+
+    def __call__(self, event, metrics):
+        if event == 'finish':
+            self.stages.append(metrics)
+        elif event == 'request':
+            self.requests['count'] += 1
+            self.requests['latency'] += metrics['latency']
+            self.requests['max_latency'] = max(self.requests['max_latency'], metrics['latency'])
+            self.requests['throttle_wait'] += metrics['throttle_wait']
+            self.requests['bytes'] += metrics['bytes'] or 0
+
+    def close(self):
+        with open(self.filename, 'w') as f:
+            codec.dump(OrderedDict([('stages', self.stages), ('requests', self.requests)]), f, indent=4)
+
+
+def setup(progress=False, metrics_filename=None):
+    """
+    Registers the standard sinks for a script. The metrics file is written when the script exits.
+    :param progress: Print progress to stderr.
+    :type progress: bool
+    :param metrics_filename: Write metrics as json to this file.
+    :type metrics_filename: str
+    """
+    if progress:
+        add_sink(StderrProgress())
+    if metrics_filename is not None:
+        add_sink(MetricsFile(metrics_filename))
+    if _sinks:
+        atexit.register(close)
+
+
+def setup_from_argv(args):
+    """
+    Handles `--progress` and `--metrics <file>` for scripts that read `sys.argv` directly.
+    :param args: command line arguments
+    :type args: list<str>
+    :return: the remaining arguments
+    :rtype: list<str>
+    """
+    remaining = []
+    progress = False
+    metrics_filename = None
+    args = iter(args)
+    for arg in args:
+        if arg == '--progress':
+            progress = True
+        elif arg == '--metrics':
+            metrics_filename = next(args, None)
+        elif arg.startswith('--metrics='):
+            metrics_filename = arg[len('--metrics='):]
+        else:
+            remaining.append(arg)
+    setup(progress, metrics_filename)
+    return remaining
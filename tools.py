@@ -3,12 +3,21 @@
 Some tools useful in conjunction with the API, for example a Trade object.
 """
 import csv
-import json
+import gzip
+import hashlib
+import io
+import lzma
+import os
+import re
 import shutil
-from collections import OrderedDict
+import sys
+from collections import Counter, OrderedDict
 from datetime import datetime, date, timezone
 from decimal import Decimal
 
+import codec
+import telemetry
+
 try:
     # noinspection PyUnresolvedReferences
     from pygments import highlight, lexers, formatters
@@ -16,6 +25,114 @@ try:
 except ImportError:
     pygments_available = False
 
+try:
+    # noinspection PyUnresolvedReferences
+    import zstandard
+    zstandard_available = True
+except ImportError:
+    zstandard_available = False
+
+
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.xz': 'xz', '.zst': 'zstd'}
+
+COMPRESSION_MAGIC = [(b'\x1f\x8b', 'gzip'), (b'\xfd7zXZ\x00', 'xz'), (b'\x28\xb5\x2f\xfd', 'zstd')]
+
+
+def split_compression(filename):
+    """
+    Splits a filename into its base name and compression.
+    E.g. `trades.json.gz` -> (`trades.json`, `gzip`), `trades.json` -> (`trades.json`, None).
+    :rtype: (str, str|None)
+    """
+    base, extension = os.path.splitext(filename)
+    compression = COMPRESSION_EXTENSIONS.get(extension.lower())
+    if compression is None:
+        return filename, None
+    return base, compression
+
+
+def detect_compression(filename):
+    """
+    Detects the compression of an existing file by its magic bytes.
+    :rtype: str|None
+    """
+    with open(filename, 'rb') as f:
+        head = f.read(6)
+    for magic, compression in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def open_file(filename, mode='r', newline=None):
+    """
+    Opens a text file, transparently (de)compressing gzip, xz or zstd.
+    When reading, the compression is detected from the file's magic bytes, when writing from the
+    extension (`.gz`, `.xz`, `.zst`).
+    :param filename: Filename
+    :type filename: str
+    :param mode: `r`, `w` or `a`
+    :type mode: str
+    :param newline: Passed on to the text wrapper, use '' for csv files.
+    :type newline: str
+    :return: file object
+    """
+    mode = mode.replace('t', '')
+    if 'r' in mode:
+        compression = detect_compression(filename)
+    else:
+        compression = split_compression(filename)[1]
+
+    if compression == 'gzip':
+        return gzip.open(filename, mode + 't', encoding='utf8', newline=newline)
+    if compression == 'xz':
+        return lzma.open(filename, mode + 't', encoding='utf8', newline=newline)
+    if compression == 'zstd':
+        if not zstandard_available:
+            raise RuntimeError(f"Install the zstandard package to read or write {filename}")
+        # noinspection PyUnresolvedReferences
+        return zstandard.open(filename, mode + 't', encoding='utf8', newline=newline)
+    return open(filename, mode, encoding='utf8', newline=newline)
+
+
+def raw_position(f):
+    """
+    Returns how many bytes of the file on disk have been read through a file object from `open_file`,
+    or None if that is not known (xz and zstd).
+    """
+    buffer = getattr(f, 'buffer', f)
+    fileobj = getattr(buffer, 'fileobj', None)
+    if fileobj is not None:
+        # gzip
+        return fileobj.tell()
+    if isinstance(buffer, io.BufferedReader):
+        return buffer.tell()
+    return None
+
+
+def write_json(data, filename, json_format=None):
+    """
+    Writes data as json, compressed if the filename asks for it.
+    :param data: Data to write. A list for json lines.
+    :type data: dict|list
+    :param filename: Filename, e.g. `trades.json`, `trades.jsonl.gz`
+    :type filename: str
+    :param json_format: `indent` (4 spaces), `compact` or `lines` (one json document per line).
+                        Default is `lines` for `.jsonl` files and `indent` otherwise.
+    :type json_format: str
+    """
+    if json_format is None:
+        json_format = 'lines' if split_compression(filename)[0].endswith('.jsonl') else 'indent'
+    with open_file(filename, 'w') as output_file:
+        if json_format == 'lines':
+            for item in data:
+                output_file.write(codec.dumps(item, compact=True))
+                output_file.write('\n')
+        elif json_format == 'compact':
+            codec.dump(data, output_file, compact=True)
+        else:
+            codec.dump(data, output_file, indent=4)
+
 
 def prettify(data, use_colors=pygments_available, indent=4, newlines=True):
     """
@@ -32,7 +149,7 @@ def prettify(data, use_colors=pygments_available, indent=4, newlines=True):
     @return: formatted output
     @rtype: str
     """
-    json_str = json.dumps(data, indent=indent)
+    json_str = codec.dumps(data, indent=indent)
     if not newlines:
         json_str = json_str.replace('\n', '')
     if use_colors and pygments_available:
@@ -42,16 +159,95 @@ def prettify(data, use_colors=pygments_available, indent=4, newlines=True):
     return json_str
 
 
-def read_trades_from_file(filename):
+class FindingWriter(object):
+    """
+    Writes findings (e.g. duplicates or unmatched movements) as soon as they are found.
+
+    Formats:
+     - `pretty`: indented json per trade, highlighted with pygments when writing to a terminal
+     - `jsonl`: one json document per finding
+     - `table`: one tab separated line per trade
+    With `summary_only`, findings are only counted and nothing is rendered.
+    """
+    FORMATS = ('pretty', 'jsonl', 'table')
+
+    TABLE_FIELDS = ('time', 'type', 'trade_id', 'exchange', 'buy_amount', 'buy_currency',
+                    'sell_amount', 'sell_currency', 'fee_amount', 'fee_currency', 'comment')
+
+    def __init__(self, output_format='pretty', file=None, use_colors=None, summary_only=False):
+        """
+        :param output_format: One of FORMATS.
+        :type output_format: str
+        :param file: Output file, default is stdout.
+        :param use_colors: Highlight pretty output. Default is True if pygments is installed and
+                           the output is a terminal.
+        :type use_colors: bool
+        :param summary_only: Only count findings.
+        :type summary_only: bool
+        """
+        if output_format not in self.FORMATS:
+            raise ValueError(f"Unknown format: {output_format}")
+        self.output_format = output_format
+        self.file = file if file is not None else sys.stdout
+        if use_colors is None:
+            use_colors = pygments_available and self.file.isatty()
+        self.use_colors = use_colors
+        self.summary_only = summary_only
+        self.counts = Counter()
+
+    def write(self, kind, trades, message=None):
+        """
+        Writes a finding.
+        :param kind: Kind of finding, e.g. `duplicate`.
+        :type kind: str
+        :param trades: Trades that make up the finding.
+        :type trades: list<Trade>
+        :param message: Optional message printed before pretty output.
+        :type message: str
+        """
+        self.counts[kind] += 1
+        if self.summary_only:
+            return
+        if self.output_format == 'jsonl':
+            record = OrderedDict([('finding', kind), ('trades', [trade.to_odict() for trade in trades])])
+            self.file.write(codec.dumps(record) + '\n')
+        elif self.output_format == 'table':
+            for trade in trades:
+                row = trade.to_odict()
+                self.file.write('\t'.join([kind] + [str(row[field]) for field in self.TABLE_FIELDS]) + '\n')
+        else:
+            if message is not None:
+                self.file.write(message + '\n')
+            for trade in trades:
+                self.file.write(prettify(trade.to_odict(), use_colors=self.use_colors) + '\n')
+
+    def write_summary(self, lines):
+        """
+        Writes summary lines. They go to stderr for machine readable formats so they don't mix with the findings.
+        """
+        file = self.file if self.output_format == 'pretty' else sys.stderr
+        for line in lines:
+            file.write(line + '\n')
+
+
+def read_trades_from_file(filename, stream=False):
     """
-    Reads trades from a json or csv file.
+    Reads trades from a json, json lines or csv file, optionally compressed with gzip, xz or zstd.
     :param filename: Filename
     :type filename: str
+    :param stream: Parse json files trade by trade instead of loading the whole document.
+                   Csv and json lines files are always read one trade at a time.
+    :type stream: bool
     :return: trades
     :rtype: list
     """
-    if filename.endswith(".csv"):
+    base = split_compression(filename)[0]
+    if base.endswith(".csv"):
         return read_trades_from_csv_file(filename)
+    elif base.endswith(".jsonl"):
+        return read_trades_from_jsonl_file(filename)
+    elif stream:
+        return iter_trades_from_json_file(filename)
     else:
         return read_trades_from_json_file(filename)
 
@@ -64,25 +260,111 @@ def read_trades_from_json_file(filename):
     :return: trades
     :rtype: list
     """
-    return json.load(open(filename), object_pairs_hook=OrderedDict)
+    progress = telemetry.Progress('read', total_bytes=os.path.getsize(filename)) if telemetry.enabled() else None
+    with open_file(filename) as f:
+        trades = codec.load(f)
+    if progress is not None:
+        progress.update(len(trades))
+        progress.finish(progress.total_bytes)
+    return trades
     # Strip API returns fields that are not trades (grrrr)
     # for key in ["success", "method"]: del result[key]
     # return result.values()
 
 
+def iter_trades_from_json_file(filename):
+    """
+    Reads trades from a json file one at a time.
+    :param filename: Filename
+    :type filename: str
+    :return: trades
+    :rtype: generator
+    """
+    with open_file(filename) as f:
+        yield from telemetry.track('read', codec.iter_array(f), total_bytes=os.path.getsize(filename),
+                                   position=lambda: raw_position(f))
+
+
+def read_trades_from_jsonl_file(filename):
+    """
+    Reads trades from a json lines file, one trade per line.
+    :param filename: Filename
+    :type filename: str
+    :return: trades
+    :rtype: generator
+    """
+    with open_file(filename) as f:
+        for line in telemetry.track('read', f, total_bytes=os.path.getsize(filename), position=lambda: raw_position(f)):
+            if line.strip():
+                yield codec.loads(line)
+
+
 def read_trades_from_csv_file(filename):
     """
     Reads trades from a csv file.
     :param filename: Filename
     :type filename: str
     :return: trades
-    :rtype: list
+    :rtype: generator
     """
     # "Type","Buy","Cur.","Buy value in USD","Sell","Cur.","Sell value in USD","Fee","Cur.","Exchange","Trade Date"
     # "type","buy_amount","buy_currency","buy_value_usd","sell_amount","sell_currency","sell_value_usd","fee_amount","fee_currency","exchange","time"
     # "Type","Buy","Cur.","Buy value in USD","Sell","Cur.","Sell value in USD","Fee","Cur.","Exchange","Imported From","Trade Group","Comment","Trade ID","Add Date","Trade Date"
     # "type","buy_amount","buy_currency","buy_value_usd","sell_amount","sell_currency","sell_value_usd","fee_amount","fee_currency","exchange","imported_from","group","comment","trade_id","imported_time","time"
-    return csv.DictReader(open(filename, newline=''))
+    with open_file(filename, newline='') as f:
+        yield from telemetry.track('read', csv.DictReader(f), total_bytes=os.path.getsize(filename),
+                                   position=lambda: raw_position(f))
+
+
+def parse_decimal(value, zero=('', '-')):
+    """
+    Converts an amount to Decimal. Strings are stripped and `zero` values count as 0;
+    numbers parsed by the codec (Decimal, int) are taken as they are.
+    :rtype: Decimal
+    """
+    if isinstance(value, str):
+        value = value.strip()
+        return Decimal(0) if value in zero else Decimal(value)
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    return Decimal(value)
+
+
+def canonical_value(value):
+    """
+    Returns a field value as a string that is equal for equal values, e.g. `0.50` and `0.5`.
+    :rtype: str
+    """
+    if isinstance(value, Decimal):
+        return '{0:f}'.format(value.normalize()) if value else '0'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def digest(values):
+    """
+    Returns a short hex digest of a sequence of field values.
+    :rtype: str
+    """
+    return hashlib.blake2b('\x1f'.join(canonical_value(value) for value in values).encode('utf8'),
+                           digest_size=16).hexdigest()
+
+
+def parse_time(value):
+    """
+    Converts a unix timestamp or a date string as used by cointracking to a (naive, UTC) datetime.
+    :rtype: datetime
+    """
+    if isinstance(value, int):
+        return datetime.utcfromtimestamp(value)
+    try:
+        return datetime.utcfromtimestamp(int(value.strip()))
+    except:
+        try:
+            return datetime.strptime(value, "%d.%m.%Y %H:%M")
+        except:
+            return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
 
 
 class Trade(object):
@@ -91,19 +373,18 @@ class Trade(object):
     The object allows for hashing, sorting, comparing and the like.
     """
 
+    # All fields, in the order of `to_odict`.
+    FIELDS = ('type', 'time', 'trade_id', 'buy_currency', 'sell_currency', 'fee_currency',
+              'buy_amount', 'sell_amount', 'fee_amount', 'buy_value_usd', 'sell_value_usd',
+              'exchange', 'group', 'comment', 'imported_from', 'imported_time')
+
     # noinspection PyShadowingBuiltins
     def __init__(self, type, time, buy_currency, sell_currency, fee_currency,
                  buy_amount, sell_amount, fee_amount, exchange, trade_id, group, comment, imported_from, imported_time, buy_value_usd="", sell_value_usd=""):
         self.type = type.strip()
         if self.type == "Gift(Out)": self.type = "Gift"
-        try:
-            self.time = datetime.utcfromtimestamp(int(time.strip()))
-        except:
-            try:
-                self.time = datetime.strptime(time, "%d.%m.%Y %H:%M")
-            except:
-                self.time = datetime.strptime(time, "%Y-%m-%dT%H:%M:%S")
-        self.trade_id = trade_id.strip()
+        self.time = parse_time(time)
+        self.trade_id = str(trade_id).strip()
         # self.buy_amount = Decimal((buy_amount != "-" and buy_amount != "0.00000000" and buy_amount.strip()) or 0)
         # self.sell_amount = Decimal((sell_amount != "-" and sell_amount != "0.00000000" and sell_amount.strip()) or 0)
         # self.fee_amount = Decimal((fee_amount != "-" and fee_amount != "0.00000000" and fee_amount.strip()) or 0)
@@ -115,28 +396,22 @@ class Trade(object):
         # self.fee_currency = fee_currency.strip() or ""
         # self.buy_value_usd = Decimal((buy_value_usd != "0.00000000" and buy_value_usd.strip()) or 0)
         # self.sell_value_usd = Decimal((sell_value_usd != "0.00000000" and sell_value_usd.strip()) or 0)
-        self.buy_amount = Decimal((buy_amount != "-" and buy_amount.strip()) or 0)
-        self.sell_amount = Decimal((sell_amount != "-" and sell_amount.strip()) or 0)
-        self.fee_amount = Decimal((fee_amount != "-" and fee_amount != "0.00000000" and fee_amount.strip()) or 0)
+        self.buy_amount = parse_decimal(buy_amount)
+        self.sell_amount = parse_decimal(sell_amount)
+        self.fee_amount = parse_decimal(fee_amount, ('', '-', '0.00000000'))
         # self.buy_currency = (self.buy_amount != Decimal(0) and buy_currency.strip()) or ""
         # self.sell_currency = (self.sell_amount != Decimal(0) and sell_currency.strip()) or ""
         # self.fee_currency = (self.fee_amount != Decimal(0) and fee_currency.strip()) or ""
         self.buy_currency = buy_currency.strip() or ""
         self.sell_currency = sell_currency.strip() or ""
         self.fee_currency = (self.fee_amount != Decimal(0) and fee_currency.strip()) or ""
-        self.buy_value_usd = Decimal(buy_value_usd.strip() or 0)
-        self.sell_value_usd = Decimal(sell_value_usd.strip() or 0)
+        self.buy_value_usd = parse_decimal(buy_value_usd)
+        self.sell_value_usd = parse_decimal(sell_value_usd)
         self.exchange = exchange.strip()
         self.group = group.strip()
         self.comment = comment.strip()
         self.imported_from = imported_from.strip()
-        try:
-            self.imported_time = datetime.utcfromtimestamp(int(imported_time.strip()))
-        except:
-            try:
-                self.imported_time = datetime.strptime(imported_time, "%d.%m.%Y %H:%M")
-            except:
-                self.imported_time = datetime.strptime(imported_time, "%Y-%m-%dT%H:%M:%S")
+        self.imported_time = parse_time(imported_time)
 
     def __key(self):
         """
@@ -150,6 +425,27 @@ class Trade(object):
             self.buy_amount, self.sell_amount, self.fee_amount
         )
 
+    def key_digest(self):
+        """
+        Digest of the fields trades are compared by, see `__key`. Equal trades have equal digests.
+        :rtype: str
+        """
+        return digest(self.__key())
+
+    def canonical_values(self):
+        """
+        All fields as canonical strings, in the order of `FIELDS`.
+        :rtype: list<str>
+        """
+        return [canonical_value(getattr(self, field)) for field in self.FIELDS]
+
+    def record_digest(self):
+        """
+        Digest of all fields, including the ones that are not part of the key such as comment or group.
+        :rtype: str
+        """
+        return digest(getattr(self, field) for field in self.FIELDS)
+
     def __eq__(self, other):
         if not isinstance(other, Trade):
             return NotImplemented
@@ -162,7 +458,7 @@ class Trade(object):
         return str(self.__key())
 
     def __str__(self):
-        return json.dumps(self.to_odict())
+        return codec.dumps(self.to_odict())
 
     def __lt__(self, other):
         return self.time < other.time
@@ -196,14 +492,186 @@ class Trade(object):
         ])
 
 
-def convert_trade_objs(trades):
+# Raw values that `Trade.to_odict` would output unchanged.
+CANONICAL_AMOUNT = re.compile(r'^-?(0|[1-9]\d*)(\.\d+)?$')
+CANONICAL_TIME = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}$')
+
+
+def _parse_string(trade, value):
+    return str(value).strip()
+
+
+def _parse_type(trade, value):
+    value = value.strip()
+    return "Gift" if value == "Gift(Out)" else value
+
+
+def _parse_amount(trade, value):
+    return parse_decimal(value)
+
+
+def _parse_fee_amount(trade, value):
+    return parse_decimal(value, ('', '-', '0.00000000'))
+
+
+def _parse_fee_currency(trade, value):
+    return (trade.fee_amount != Decimal(0) and value.strip()) or ""
+
+
+def _parse_time(trade, value):
+    return parse_time(value)
+
+
+def _format_string(value):
+    return value
+
+
+def _format_amount(value):
+    return '{0:f}'.format(value)
+
+
+def _format_time(value):
+    return value.isoformat()
+
+
+def _is_canonical_string(value):
+    return isinstance(value, str) and value == value.strip()
+
+
+def _is_canonical_type(value):
+    return _is_canonical_string(value) and value != "Gift(Out)"
+
+
+def _is_canonical_amount(value):
+    return isinstance(value, str) and CANONICAL_AMOUNT.match(value) is not None
+
+
+def _is_canonical_fee_amount(value):
+    return _is_canonical_amount(value) and value != "0.00000000"
+
+
+def _is_canonical_fee_currency(value):
+    return value == ""
+
+
+def _is_canonical_time(value):
+    return isinstance(value, str) and CANONICAL_TIME.match(value) is not None
+
+
+class LazyField(object):
+    """
+    A trade field that is parsed from the raw record on first access.
+    This is a non-data descriptor: the parsed value is stored in the instance and found there on
+    later accesses, and assigning a field simply replaces it.
+    """
+
+    def __init__(self, parse, format, is_canonical, default=None):
+        """
+        :param parse: Parses the raw value, called with the trade and the value.
+        :type parse: callable
+        :param format: Formats a parsed value the way `Trade.to_odict` does.
+        :type format: callable
+        :param is_canonical: Returns True if a raw value is exactly what `format` would output.
+        :type is_canonical: callable
+        :param default: Raw value if the record does not have the field.
+        """
+        self.parse = parse
+        self.format = format
+        self.is_canonical = is_canonical
+        self.default = default
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def raw(self, trade):
+        value = trade.raw.get(self.name, self.default)
+        if value is None:
+            raise KeyError(f"Trade is missing field '{self.name}'")
+        return value
+
+    def __get__(self, trade, owner=None):
+        if trade is None:
+            return self
+        value = self.parse(trade, self.raw(trade))
+        trade.__dict__[self.name] = value
+        return value
+
+
+class LazyTrade(Trade):
+    """
+    A trade that keeps its raw record and only parses the fields that are used.
+
+    Behaves like `Trade`. `to_odict` reuses the raw strings of fields that were never accessed
+    or assigned, as long as they are already in the output format.
+    """
+    type = LazyField(_parse_type, _format_string, _is_canonical_type)
+    time = LazyField(_parse_time, _format_time, _is_canonical_time)
+    trade_id = LazyField(_parse_string, _format_string, _is_canonical_string)
+    buy_currency = LazyField(_parse_string, _format_string, _is_canonical_string)
+    sell_currency = LazyField(_parse_string, _format_string, _is_canonical_string)
+    fee_currency = LazyField(_parse_fee_currency, _format_string, _is_canonical_fee_currency)
+    buy_amount = LazyField(_parse_amount, _format_amount, _is_canonical_amount)
+    sell_amount = LazyField(_parse_amount, _format_amount, _is_canonical_amount)
+    fee_amount = LazyField(_parse_fee_amount, _format_amount, _is_canonical_fee_amount)
+    buy_value_usd = LazyField(_parse_amount, _format_amount, _is_canonical_amount, "")
+    sell_value_usd = LazyField(_parse_amount, _format_amount, _is_canonical_amount, "")
+    exchange = LazyField(_parse_string, _format_string, _is_canonical_string)
+    group = LazyField(_parse_string, _format_string, _is_canonical_string)
+    comment = LazyField(_parse_string, _format_string, _is_canonical_string)
+    imported_from = LazyField(_parse_string, _format_string, _is_canonical_string)
+    imported_time = LazyField(_parse_time, _format_time, _is_canonical_time)
+
+    # noinspection PyMissingConstructor
+    def __init__(self, raw):
+        """
+        :param raw: Trade as exported by cointracking.
+        :type raw: dict
+        """
+        self.raw = raw
+
+    def to_odict(self):
+        output = OrderedDict()
+        parsed = self.__dict__
+        for field in self.FIELDS:
+            descriptor = LAZY_FIELDS[field]
+            if field in parsed:
+                output[field] = descriptor.format(parsed[field])
+                continue
+            value = descriptor.raw(self)
+            output[field] = value if descriptor.is_canonical(value) else descriptor.format(getattr(self, field))
+        return output
+
+
+LAZY_FIELDS = {field: LazyTrade.__dict__[field] for field in Trade.FIELDS}
+
+
+def iter_trade_objs(trades, lazy=False):
+    """
+    Converts trade dicts to Trade objects one at a time.
+    :param trades: Trades as exported by cointracking.
+    :type trades: iterable
+    :param lazy: Create `LazyTrade`s that only parse the fields that are used.
+    :type lazy: bool
+    :rtype: generator
+    """
+    for trade in telemetry.track('convert', trades):
+        yield LazyTrade(trade) if lazy else Trade(**trade)
+
+
+def convert_trade_objs(trades, lazy=False):
     """
     Converts trade dicts to Trade objects.
     :param trades: Trades as exported by cointracking.
     :type trades: list
+    :param lazy: Create `LazyTrade`s that only parse the fields that are used.
+    :type lazy: bool
     :return: Ordered list of objects.
     :rtype: list<Trade>
     """
+    trades = telemetry.track('convert', trades)
+    if lazy:
+        return [LazyTrade(trade) for trade in trades]
     trade_objs = []
     for trade in trades:
         # Create trade object. Handle exceptions which mean that we hit an unexpected record.
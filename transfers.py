@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Links the two legs of a transfer (a withdrawal and the matching deposit) before the tax engine runs.
+
+Movements are indexed by (currency, net amount), where the net amount is what left the source
+after fees and what arrived at the destination before fees, the same rule `find_unmatched_movements.py`
+uses. Within a key, legs are paired in time order with the oldest open leg of the other direction
+that is within the time window. The legs do not have to be adjacent in the trade stream and the
+deposit may even be booked before the withdrawal.
+
+Legs left over after that are paired by currency alone, again with the oldest open leg of the
+other direction within the window, so a transfer whose fee was not recorded (1 BTC withdrawn,
+0.9995 BTC deposited) is still linked. The deposit must not be more than the withdrawal and
+may only be short of it by `FEE_TOLERANCE`. Only legs that find no partner either way stay unpaired.
+"""
+from collections import deque
+from decimal import Decimal
+
+
+# Default maximum time between the two legs of a transfer, in seconds.
+DEFAULT_WINDOW = 24 * 3600
+
+# Largest share of a withdrawal that may be missing from a deposit paired by currency alone (an unrecorded fee).
+FEE_TOLERANCE = Decimal('0.01')
+
+
+def movement_key(trade):
+    """
+    Returns the (currency, net amount) a movement is indexed by, or None for other trade types.
+    """
+    if trade.type == 'Withdrawal':
+        return trade.sell_currency, trade.sell_amount - trade.fee_amount
+    if trade.type == 'Deposit':
+        return trade.buy_currency, trade.buy_amount + trade.fee_amount
+    return None
+
+
+def movement_currency(trade):
+    return trade.sell_currency if trade.type == 'Withdrawal' else trade.buy_currency
+
+
+def within_fee(withdrawal, deposit, tolerance=FEE_TOLERANCE):
+    """
+    Returns True if the deposit's net amount is at most the withdrawal's, and short of it by no more
+    than `tolerance` of the withdrawal.
+    """
+    withdrawn = movement_key(withdrawal)[1]
+    deposited = movement_key(deposit)[1]
+    return withdrawn * (1 - tolerance) <= deposited <= withdrawn
+
+
+class TransferLinks(object):
+    """
+    Withdrawal/deposit pairs found by `link_transfers`.
+    Only the legs that were not reached yet are referenced, so processed trades can be freed.
+    """
+
+    def __init__(self, pairs, unpaired, approximate=()):
+        """
+        :param pairs: (withdrawal, deposit) tuples
+        :type pairs: list<(Trade, Trade)>
+        :param unpaired: Movements without a counterpart.
+        :type unpaired: list<Trade>
+        :param approximate: The pairs that were only matched by currency, not by net amount.
+        :type approximate: list<(Trade, Trade)>
+        """
+        self.num_pairs = len(pairs)
+        self.num_unpaired = len(unpaired)
+        self.num_approximate = len(approximate)
+        # Keyed by object id: equal trades (duplicates) must not be confused with each other.
+        self._partners = {}
+        for withdrawal, deposit in pairs:
+            self._partners[id(withdrawal)] = deposit
+            self._partners[id(deposit)] = withdrawal
+        self._approximate = set(id(withdrawal) for withdrawal, _ in approximate)
+        self._done = set()
+
+    def __len__(self):
+        return self.num_pairs
+
+    def is_linked(self, trade):
+        return id(trade) in self._partners or id(trade) in self._done
+
+    def update(self, links):
+        """
+        Adds the pairs of links found among later or still unpaired movements.
+        The unpaired count is taken over from `links`.
+        :type links: TransferLinks
+        """
+        self.num_pairs += links.num_pairs
+        self.num_unpaired = links.num_unpaired
+        self.num_approximate += links.num_approximate
+        self._partners.update(links._partners)
+        self._approximate.update(links._approximate)
+
+    def complete(self, trade):
+        """
+        Marks a leg as reached in the trade stream. The transfer happens at whichever leg comes first:
+        once either leg is booked the coins are no longer available at the source.
+        :return: withdrawal, deposit and whether they were only paired by currency for the first leg
+                 of a transfer, None for the second one
+        :rtype: (Trade, Trade, bool)|None
+        """
+        if id(trade) in self._done:
+            self._done.discard(id(trade))
+            return None
+        partner = self._partners.pop(id(trade))
+        del self._partners[id(partner)]
+        self._done.add(id(partner))
+        withdrawal, deposit = (trade, partner) if trade.type == 'Withdrawal' else (partner, trade)
+        approximate = id(withdrawal) in self._approximate
+        self._approximate.discard(id(withdrawal))
+        return withdrawal, deposit, approximate
+
+
+def _pair(movements, key, window, matches=None):
+    """
+    Pairs movements sorted by time with the oldest open leg of the other direction that has the same key.
+    :param matches: Optional test of a (withdrawal, deposit) pair, legs that fail it are not paired.
+    :type matches: callable
+    :return: pairs and the legs left over, in time order
+    :rtype: (list<(Trade, Trade)>, list<Trade>)
+    """
+    # Open legs per key and direction, oldest first.
+    open_legs = {}
+    pairs = []
+    unpaired = []
+    for trade in movements:
+        waiting = open_legs.setdefault(key(trade), {'Withdrawal': deque(), 'Deposit': deque()})
+        counterparts = waiting['Deposit' if trade.type == 'Withdrawal' else 'Withdrawal']
+        while counterparts and (trade.time - counterparts[0].time).total_seconds() > window:
+            unpaired.append(counterparts.popleft())
+        for i, other in enumerate(counterparts):
+            pair = (trade, other) if trade.type == 'Withdrawal' else (other, trade)
+            if matches is None or matches(*pair):
+                del counterparts[i]
+                pairs.append(pair)
+                break
+        else:
+            waiting[trade.type].append(trade)
+
+    for waiting in open_legs.values():
+        for legs in waiting.values():
+            unpaired.extend(legs)
+    unpaired.sort(key=lambda trade: trade.time)
+    return pairs, unpaired
+
+
+def link_transfers(trade_objs, window=DEFAULT_WINDOW, fee_tolerance=FEE_TOLERANCE):
+    """
+    Pairs withdrawals with deposits, by currency and net amount first and then by currency alone.
+    Runs in O(n log n) for the first pass.
+    :param trade_objs: Trades, other trade types are ignored.
+    :type trade_objs: iterable
+    :param window: Maximum time between the two legs in seconds.
+    :type window: int
+    :param fee_tolerance: See `within_fee`.
+    :type fee_tolerance: Decimal
+    :rtype: TransferLinks
+    """
+    movements = [trade for trade in trade_objs if trade.type == 'Withdrawal' or trade.type == 'Deposit']
+    movements.sort(key=lambda trade: trade.time)
+
+    pairs, leftover = _pair(movements, movement_key, window)
+    approximate, unpaired = _pair(leftover, movement_currency, window,
+                                  lambda withdrawal, deposit: within_fee(withdrawal, deposit, fee_tolerance))
+    return TransferLinks(pairs + approximate, unpaired, approximate)